@@ -51,8 +51,11 @@
 
 
 # Load dependencies (some functions might also require scipy, which is then
-# loaded inside the function definition)
+# loaded inside the function definition). Numba is optional, if available it is
+# used to compile the kernels of the rotation optimization (see set_backend). It
+# is only imported when the kernels are first used
 import numpy as np
+import os
 
 
 ##################################################################################
@@ -63,11 +66,16 @@ import numpy as np
 # Tensor class
 class Tensor:
 # Initialization
- def __init__(self, tensor, form = None, normalized = False, verbose = True):
+ def __init__(self, tensor, form = None, normalized = False, verbose = True, reduce = False,
+              dtype = None):
   self.verbose = verbose
+  self.dtype = dtype
   self.normalized = normalized
   shape = check_shape(tensor, verbose)
   self.shape = shape
+# Unimodular transformation applied to the lattice matrix when the cell is reduced
+# (see reduce_lat for the limitations of reduce = True with rotated cells)
+  transformation = None
 # Process a piezoelectric tensor
   if shape[0] == "piezoelectric":
    if not form or form not in ["e", "d"]:
@@ -89,37 +97,47 @@ class Tensor:
     voigt = tensorize_pz_voigt(vector, form)
     cartesian = pz_voigt_to_cartesian(voigt, form)
    components = get_components(voigt, shape)
-# Process an elastic tensor
+# Process an elastic tensor, either in stiffness ("C") or compliance ("S") form
   if shape[0] == "elastic":
+   if form not in ["C", "S"]:
+    if form:
+     print_ela_form_warning(verbose)
+    form = "C"
    if shape[1] == "voigt":
     voigt = symmetrize_tensor(tensor, shape, verbose)
-    cartesian = ela_voigt_to_cartesian(voigt)
-    vector = vectorize_ela_voigt(voigt)
+    cartesian = ela_voigt_to_cartesian(voigt, form)
+    vector = vectorize_ela_voigt(voigt, form)
    if shape[1] == "cartesian":
     cartesian = symmetrize_tensor(tensor, shape, verbose)
-    voigt = ela_cartesian_to_voigt(cartesian)
-    vector = vectorize_ela_voigt(voigt)
+    voigt = ela_cartesian_to_voigt(cartesian, form)
+    vector = vectorize_ela_voigt(voigt, form)
    if shape[1] == "vector":
     if not normalized:
-     vector = normalize_ela_vector(tensor)
+     vector = normalize_ela_vector(tensor, form)
     else:
      vector = tensor
-    voigt = tensorize_ela_voigt(vector)
-    cartesian = ela_voigt_to_cartesian(voigt)
+    voigt = tensorize_ela_voigt(vector, form)
+    cartesian = ela_voigt_to_cartesian(voigt, form)
    components = get_components(voigt, shape)
 # Process a lattice matrix
   if shape[0] == "lattice":
    if shape[1] == "cartesian":
     cartesian = np.array(tensor)
+    if reduce:
+     cartesian, transformation = reduce_lat(cartesian)
     voigt = None
     vector = cartesian.flatten()
     components = cartesian.flatten()
+# Store the vector form in the requested precision (used for the projections)
+  if dtype is not None:
+   vector = np.array(vector, dtype=dtype)
 # Pass values to self
   self.form = form
   self.vector = vector
   self.voigt = voigt
   self.cartesian = cartesian
   self.components = components
+  self.transformation = transformation
 # Define intrinsic methods
 # Rotate method
  def rotate(self, angles):
@@ -132,32 +150,78 @@ class Tensor:
    components = get_components(voigt, shape)
   if shape[0] == "elastic":
    cartesian = rotate_ela(self.cartesian, angles)
-   voigt = ela_cartesian_to_voigt(cartesian)
-   vector = vectorize_ela_voigt(voigt)
+   voigt = ela_cartesian_to_voigt(cartesian, form)
+   vector = vectorize_ela_voigt(voigt, form)
    components = get_components(voigt, shape)
   if shape[0] == "lattice":
    cartesian = rotate_lat(self.cartesian, angles)
    voigt = None
    vector = cartesian.flatten()
    components = cartesian.flatten()
+  if self.dtype is not None:
+   vector = np.array(vector, dtype=self.dtype)
   self.vector = vector
   self.voigt = voigt
   self.cartesian = cartesian
   self.components = components
-# Project method
- def get_projection(self, sym = None, shapeout = None, verbose = None):
+# Convert method: switches an elastic tensor between stiffness ("C") and
+# compliance ("S") forms. A piezoelectric tensor is switched between the d and
+# e forms with the companion elastic Tensor (see convert_pz_batch for factor)
+ def convert(self, form, elastic = None, factor = 1.):
+  shape = self.shape
+  if shape[0] == "piezoelectric" and elastic is not None:
+   if form not in ["e", "d"] or form == self.form:
+    return
+   voigt = convert_pz_batch(self, elastic, form, factor = factor, verbose = self.verbose)[0].tolist()
+   self.form = form
+   self.vector = vectorize_pz_voigt(voigt, form)
+   if self.dtype is not None:
+    self.vector = np.array(self.vector, dtype=self.dtype)
+   self.voigt = voigt
+   self.cartesian = pz_voigt_to_cartesian(voigt, form)
+   self.components = get_components(voigt, shape)
+   return
+  if shape[0] != "elastic":
+   return
+  if form not in ["C", "S"]:
+   print_ela_form_warning(self.verbose)
+   form = "C"
+  if form == self.form:
+   return
+  voigt = invert_ela_voigt(self.voigt, self.form).tolist()
+  self.form = form
+  self.vector = vectorize_ela_voigt(voigt, form)
+  if self.dtype is not None:
+   self.vector = np.array(self.vector, dtype=self.dtype)
+  self.voigt = voigt
+  self.cartesian = ela_voigt_to_cartesian(voigt, form)
+  self.components = get_components(voigt, shape)
+# Project method. For elastic tensors the projection can be carried out in
+# either stiffness or compliance space (keyword "form"), the result being
+# returned in that same form. The projection is done in the precision given by
+# dtype at initialization (double precision by default). If the standard
+# deviations of the components (sigma) are given, the mean and standard deviation
+# of the projection are returned instead (see projection_uncertainty)
+ def get_projection(self, sym = None, shapeout = None, verbose = None, form = None,
+                    sigma = None, nsamples = 1000, seed = 0):
   if verbose == None:
    verbose = self.verbose
+  if sigma is not None:
+   return projection_uncertainty(self, sym, sigma, nsamples, seed, form, verbose)
   shape = self.shape
   normalized = self.normalized
-  form = self.form
+  if form not in ["C", "S"] or shape[0] != "elastic":
+   form = self.form
+  vector = self.vector
+  if form != self.form:
+   vector = vectorize_ela_voigt(invert_ela_voigt(self.voigt, self.form), form)
   if shapeout == None:
    if shape[1] == "vector" and not normalized:
     shapeout = "components"
    else:
     shapeout = shape[1]
   if shape[0] == "piezoelectric":
-   proj = project_pz(self.vector, sym, verbose)
+   proj = project_pz(self.vector, sym, verbose, self.dtype)
    vector = []
    for i in range(0,18):
     vector.append(proj[i])
@@ -165,15 +229,19 @@ class Tensor:
    components = get_components(voigt, shape)
    cartesian = pz_voigt_to_cartesian(voigt, form)
   if shape[0] == "elastic":
-   proj = project_ela(self.vector, sym, verbose)
+   proj = project_ela(vector, sym, verbose, self.dtype)
    vector = []
    for i in range(0,21):
     vector.append(proj[i])
-   voigt = tensorize_ela_voigt(vector)
+   voigt = tensorize_ela_voigt(vector, form)
    components = get_components(voigt, shape)
-   cartesian = ela_voigt_to_cartesian(voigt)
+   cartesian = ela_voigt_to_cartesian(voigt, form)
   if shape[0] == "lattice":
-   proj = project_lat(self.vector, sym, verbose)
+   vector = self.vector
+# A reduced cell is first brought into the setting of the symmetry
+   if self.transformation is not None:
+    vector = lat_setting(self.cartesian, sym, verbose)[0].flatten()
+   proj = project_lat(vector, sym, verbose, self.dtype)
    vector = []
    for i in range(0,9):
     vector.append(proj[i])
@@ -189,28 +257,223 @@ class Tensor:
    return voigt
   if shapeout == "cartesian":
    return cartesian
-# Distances method
+# Distances method. If a DistanceCache is given (or enabled by default with
+# enable_distance_cache) the results are read from it when available and the
+# newly computed ones are stored in it. Use cache = False to bypass the default.
+# If the standard deviations of the components (sigma) are given, the
+# distribution of the distances is computed instead (see distance_uncertainty)
  def get_distances(self, form = None, symlist = None,
-                   rotate = False, xtol = 1e-8, verbose = None, printmin = False, normalize=False):
+                   rotate = False, xtol = 1e-8, verbose = None, printmin = False, normalize=False,
+                   bounds = False, cache = None, method = "fmin", popsize = 30, tolerance = 1e-6,
+                   sigma = None, nsamples = 1000, seed = 0, tol = None):
   if verbose == None:
    verbose = self.verbose
   if form == None:
    form = self.form
   shape = self.shape
+  if cache == None:
+   cache = distance_cache
   if symlist == None:
-   if shape[0] == "piezoelectric":
-    symlist = ["432", "-43m", "6", "-6", "622", "6mm", "-62m", "3", "32",
-               "3m", "-4", "-42m", "2", "222", "m", "-2", "mm2", "1"]
+   symlist = get_default_symlist(shape[0])
+  if sigma is not None:
+   return distance_uncertainty(self, sigma, nsamples, seed, form, symlist, rotate, xtol, normalize,
+                               tol, method, verbose)
+# Read the available results from the cache and only compute the missing ones
+  if isinstance(cache, DistanceCache):
+   vector = self.vector
    if shape[0] == "elastic":
-    symlist = ["iso", "cub", "hex", "3", "32", "4", "4mm", "ort", "mon"]
-   if shape[0] == "lattice":
-    symlist = ["hex"]
+    if form not in ["C", "S"]:
+     form = self.form
+    if form != self.form:
+     vector = vectorize_ela_voigt(invert_ela_voigt(self.voigt, self.form), form)
+   printdist = get_printdist(shape[0], form)
+   settings = method
+   if method == "de":
+    settings = "de:%d:%r" % (popsize, tolerance)
+   if self.transformation is not None:
+    settings = settings + ":setting"
+   if self.dtype is not None:
+    settings = settings + ":" + np.dtype(self.dtype).str
+   keys = [cache.get_key(shape[0], form, vector, sym, rotate, xtol, normalize, settings) for sym in symlist]
+   result = [cache.get(key) for key in keys]
+   if self.dtype is not None:
+    for row in result:
+     if row is not None:
+      row[1] = np.dtype(self.dtype).type(row[1])
+   print_cached_results([row for row in result if row is not None], printdist, verbose)
+   missing = [symlist[i] for i in range(0,len(symlist)) if result[i] is None]
+   if len(missing) > 0:
+    computed = self.get_distances(form, missing, rotate, xtol, verbose, printmin, normalize,
+                                  bounds = False, cache = False, method = method, popsize = popsize,
+                                  tolerance = tolerance)
+    for i in range(0,len(symlist)):
+     if result[i] is None:
+      result[i] = computed.pop(0)
+      cache.put(keys[i], result[i])
+   if bounds and shape[0] != "lattice":
+    lower = harmonic_bounds(vector, shape[0], symlist, normalize)
+    for i in range(0,len(result)):
+     result[i].append(lower[i][1])
+    print_harmonic_bounds(lower, printdist, verbose)
+   return result
   if shape[0] == "piezoelectric":
-   return pz_dist(self.voigt, form, symlist, rotate, xtol, verbose, printmin, normalize)
+   return pz_dist(self.voigt, form, symlist, rotate, xtol, verbose, printmin, normalize, bounds,
+                  method, popsize, tolerance, self.dtype)
   if shape[0] == "elastic":
-   return ela_dist(self.voigt, symlist, rotate, xtol, verbose, printmin, normalize)
+   voigt = self.voigt
+   if form not in ["C", "S"]:
+    form = self.form
+   if form != self.form:
+    voigt = invert_ela_voigt(self.voigt, self.form).tolist()
+   return ela_dist(voigt, symlist, rotate, xtol, verbose, printmin, normalize, form, bounds,
+                   method, popsize, tolerance, self.dtype)
   if shape[0] == "lattice":
-   return lat_dist(self.vector, symlist, rotate, xtol, verbose, printmin, normalize)
+   return lat_dist(self.vector, symlist, rotate, xtol, verbose, printmin, normalize, method,
+                   popsize, tolerance, setting = self.transformation is not None, dtype = self.dtype)
+# Asynchronous distances and projection methods: same as get_distances and
+# get_projection, but they can be awaited within an asyncio event loop, the work
+# being done in an executor (see run_async for the executor and semaphore options)
+ async def aget_distances(self, *args, executor = None, semaphore = None, **kwargs):
+  return await run_async(self.get_distances, *args, executor = executor, semaphore = semaphore,
+                         **kwargs)
+ async def aget_projection(self, *args, executor = None, semaphore = None, **kwargs):
+  return await run_async(self.get_projection, *args, executor = executor, semaphore = semaphore,
+                         **kwargs)
+# Symmetry identification method: returns the highest symmetry within tol as
+# [sym, edist, tx, ty, tz], or None (see find_highest_symmetry)
+ def identify_symmetry(self, tol, symlist = None, normalize = False, method = "poly", xtol = 1e-8,
+                       verbose = None):
+  if verbose == None:
+   verbose = self.verbose
+  result, log = find_highest_symmetry(self.vector, self.shape[0], tol, symlist, normalize, method,
+                                      xtol)
+  print_symmetry_log(log, result, get_printdist(self.shape[0], self.form), verbose)
+  return result
+# Canonicalize method: rotates the tensor into its standard orientation (see
+# canonical_rotation) and returns the rotation angles used
+ def canonicalize(self, tol = 1e-4):
+  shape = self.shape
+  R = canonical_rotation(self.vector, shape[0], tol)
+  angles = rotation_angles(R)
+  self.rotate(angles)
+  return angles
+# Hash method: hash of the canonical form of the tensor (see tensor_hashes)
+ def get_hash(self, quantum = 1e-2, normalize = False, tol = 1e-4):
+  return tensor_hashes(self, quantum, normalize, tol)[0]
+# Harmonic decomposition method, returns a dictionary with the harmonic
+# components of the tensor (see get_harmonic_projectors) in the requested shape
+ def get_harmonic(self, shapeout = None):
+  shape = self.shape
+  form = self.form
+  if shape[0] not in ["elastic", "piezoelectric"]:
+   return None
+  if shapeout == None:
+   shapeout = shape[1]
+  parts = harmonic_decomposition(self.vector, shape[0])
+  for key in parts:
+   if shapeout == "vector":
+    continue
+   if shape[0] == "elastic":
+    voigt = tensorize_ela_voigt_batch(parts[key], form)
+    cartesian = ela_voigt_to_cartesian_batch(voigt, form)
+   if shape[0] == "piezoelectric":
+    voigt = tensorize_pz_voigt_batch(parts[key], form)
+    cartesian = np.array(pz_voigt_to_cartesian(voigt, form))
+   if shapeout == "components":
+    parts[key] = np.array(get_components(voigt, shape))
+   if shapeout == "voigt":
+    parts[key] = voigt
+   if shapeout == "cartesian":
+    parts[key] = cartesian
+  return parts
+# Directional properties method (optionally for the projection onto a given
+# symmetry), see ela_directional and pz_directional. The refine and xtol options
+# apply only to piezoelectric tensors
+ def get_directional(self, directions, sym = None, nperp = 36, verbose = None,
+                     refine = False, xtol = 1e-8):
+  if verbose == None:
+   verbose = self.verbose
+  shape = self.shape
+  if shape[0] == "elastic":
+   voigt = self.voigt
+   if sym:
+    voigt = self.get_projection(sym, shapeout = "voigt", verbose = verbose)
+   return ela_directional(voigt, directions, self.form, nperp)
+  if shape[0] == "piezoelectric":
+   cartesian = self.cartesian
+   if sym:
+    cartesian = self.get_projection(sym, shapeout = "cartesian", verbose = verbose)
+   return pz_directional(cartesian, directions, nperp, refine, xtol)
+# Aggregate moduli method (optionally for the projection onto a given
+# symmetry), see ela_aggregates
+ def get_aggregates(self, sym = None, verbose = None):
+  if verbose == None:
+   verbose = self.verbose
+  if self.shape[0] != "elastic":
+   return None
+  voigt = self.voigt
+  if sym:
+   voigt = self.get_projection(sym, shapeout = "voigt", verbose = verbose)
+  return ela_aggregates(voigt, self.form)
+# Orientation average method for elastic and piezoelectric tensors over a set
+# of grain orientations (see orientation_average). For piezoelectric tensors the
+# companion elastic Tensor can be given to get the Voigt, Reuss and Hill averages
+ def get_orientation_average(self, orientations, weights = None, elastic = None,
+                             chunksize = 10000, verbose = None):
+  if verbose == None:
+   verbose = self.verbose
+  if self.shape[0] not in ["elastic", "piezoelectric"]:
+   return None
+  result = orientation_average(self, orientations, weights, elastic = elastic,
+                               chunksize = chunksize, verbose = verbose)
+  for key in result:
+   result[key] = result[key][0].tolist()
+  return result
+# Mechanical stability method for elastic tensors, optionally with the Born
+# criteria of a given symmetry for the projected tensor (see born_stability)
+ def get_stability(self, sym = None, tol = 0., verbose = None):
+  if verbose == None:
+   verbose = self.verbose
+  if self.shape[0] != "elastic":
+   return None
+  result = born_stability(self, sym = sym, tol = tol, verbose = verbose)
+  for key in result:
+   if key == "criteria":
+    result[key] = {name: bool(result[key][name][0]) for name in result[key]}
+   else:
+    result[key] = result[key][0]
+  return result
+# Acoustic phase velocities and polarizations method for elastic tensors (see
+# christoffel). A companion piezoelectric Tensor and the permittivity (3x3, F/m)
+# can be given to include the piezoelectric stiffening. A tensor in d form is
+# converted to e form with this elastic tensor (see convert_pz_batch), dunit
+# being the factor that takes d to C/N (d in pC/N by default)
+ def get_velocities(self, directions, density, piezo = None, permittivity = None,
+                    sym = None, punit = 1e9, dunit = 1e-12, verbose = None):
+  if verbose == None:
+   verbose = self.verbose
+  if self.shape[0] != "elastic":
+   return None
+  voigt = self.voigt
+  if sym:
+   voigt = self.get_projection(sym, shapeout = "voigt", verbose = verbose)
+  e_cart = None
+  if piezo is not None:
+   if permittivity is None:
+    if verbose:
+     print("                                                                   ")
+     print("************************** W A R N I N G **************************")
+     print("Warning! The piezoelectric stiffening requires the permittivity    ")
+     print("tensor. I'm ignoring the piezoelectric contribution!               ")
+     print("************************** W A R N I N G **************************")
+     print("                                                                   ")
+   elif piezo.form == "d":
+    e_voigt = convert_pz_batch(piezo, voigt, "e", elastic_form = self.form,
+                               factor = dunit * punit, verbose = verbose)[0]
+    e_cart = pz_voigt_to_cartesian(e_voigt, "e")
+   else:
+    e_cart = piezo.cartesian
+  return christoffel(voigt, directions, density, self.form, e_cart, permittivity, punit)
 ##################################################################################
 # Check the shape passed to the Tensor class
 def check_shape(tensor, verbose = True):
@@ -453,7 +716,7 @@ def normalize_pz_vector(tensor, form):
      level0.append(tensor[k]/np.sqrt(2.))
  return level0
 ##################################################################################
-def normalize_ela_vector(tensor):
+def normalize_ela_vector(tensor, form = "C"):
  level0 = []
  for i in range(0,6):
   sumi = 0
@@ -471,9 +734,9 @@ def normalize_ela_vector(tensor):
    if i != j:
     coeff /= np.sqrt(2.)
    if i >= 3:
-    coeff /= np.sqrt(2.)
+    coeff /= get_ela_shear_factor(form)
    if j >= 3:
-    coeff /= np.sqrt(2.)
+    coeff /= get_ela_shear_factor(form)
    level0.append(tensor[k]/coeff)
  return level0
 ##################################################################################
@@ -489,6 +752,387 @@ def get_components(voigt, shape):
     level0.append(voigt[i][j])
  return level0
 ##################################################################################
+# Returns an (npoints,3) array of unit vectors evenly distributed on the sphere
+# (Fibonacci lattice). Useful to evaluate directional properties on a dense mesh
+def sphere_mesh(npoints = 1000):
+ k = np.arange(0, npoints) + 0.5
+ z = 1. - 2.*k/npoints
+ r = np.sqrt(1. - z**2)
+ phi = np.pi * (1. + np.sqrt(5.)) * k
+ return np.stack([r*np.cos(phi), r*np.sin(phi), z], axis=1)
+##################################################################################
+# Returns, for each unit vector in an (M,3) array of directions, nperp unit
+# vectors perpendicular to it, evenly spaced in [0,180) degrees, shape (M,nperp,3)
+def perpendicular_directions(directions, nperp = 36):
+ n = np.array(directions, dtype=float).reshape(-1,3)
+ n = n / np.linalg.norm(n, axis=1)[:, None]
+ ref = np.zeros(n.shape)
+ ref[:, 2] = 1.
+ ref[np.abs(n[:, 2]) > 0.9] = [1., 0., 0.]
+ u = np.cross(n, ref)
+ u = u / np.linalg.norm(u, axis=1)[:, None]
+ w = np.cross(n, u)
+ phi = np.pi * np.arange(0, nperp) / nperp
+ return np.cos(phi)[None, :, None] * u[:, None, :] + np.sin(phi)[None, :, None] * w[:, None, :]
+##################################################################################
+# Returns the rotation matrix R = Rz.Ry.Rx used by the rotate_* functions for
+# the given angles tx, ty, tz (in degrees). Works also with arrays of angles of
+# shape (...,3), returning (...,3,3)
+def rotation_matrix(rot_angles):
+ f = np.pi / 180.
+ t = f * np.array(rot_angles, dtype=float)
+ cx = np.cos(t[..., 0]) ; sx = np.sin(t[..., 0])
+ cy = np.cos(t[..., 1]) ; sy = np.sin(t[..., 1])
+ cz = np.cos(t[..., 2]) ; sz = np.sin(t[..., 2])
+ R = np.empty(t.shape[:-1] + (3,3))
+ R[..., 0, 0] = cz*cy ; R[..., 0, 1] = cz*sy*sx - sz*cx ; R[..., 0, 2] = cz*sy*cx + sz*sx
+ R[..., 1, 0] = sz*cy ; R[..., 1, 1] = sz*sy*sx + cz*cx ; R[..., 1, 2] = sz*sy*cx - cz*sx
+ R[..., 2, 0] = -sy   ; R[..., 2, 1] = cy*sx            ; R[..., 2, 2] = cy*cx
+ return R
+##################################################################################
+# Returns the angles tx, ty, tz (in degrees) of a rotation matrix R = Rz.Ry.Rx,
+# i.e., the inverse of rotation_matrix. Works also with (...,3,3) stacks
+def rotation_angles(R):
+ R = np.array(R, dtype=float)
+ tx = np.arctan2(R[..., 2, 1], R[..., 2, 2])
+ ty = -np.arcsin(np.clip(R[..., 2, 0], -1., 1.))
+ tz = np.arctan2(R[..., 1, 0], R[..., 0, 0])
+ return np.degrees(np.stack([tx, ty, tz], axis=-1))
+##################################################################################
+# Orthonormal basis of symmetric 3x3 matrices in Kelvin (Mandel) order 11, 22,
+# 33, 23, 13, 12. Shape (6,3,3)
+def get_mandel_basis():
+ basis = np.zeros((6,3,3))
+ for I in range(0,3):
+  basis[I][I][I] = 1.
+ for I, (i, j) in enumerate([(1, 2), (0, 2), (0, 1)]):
+  basis[I+3][i][j] = 1./np.sqrt(2.)
+  basis[I+3][j][i] = 1./np.sqrt(2.)
+ return basis
+##################################################################################
+# Returns the 6x6 matrix Q(R) that rotates symmetric second-rank tensors in
+# Kelvin (Mandel) notation, so that an elastic tensor in Kelvin notation rotates
+# as Q.C.Q^T and a piezoelectric one as R.E.Q^T. Works with (...,3,3) stacks
+def get_mandel_rotation(R):
+ R = np.array(R, dtype=float)
+ basis = get_mandel_basis()
+ kernel = np.einsum("Iab,Jcd->acbdIJ", basis, basis).reshape(81,36)
+ RR = np.einsum("...ac,...bd->...acbd", R, R).reshape(R.shape[:-2] + (81,))
+ return np.matmul(RR, kernel).reshape(R.shape[:-2] + (6,6))
+##################################################################################
+# Rotates tensors given in vector form (the norm-preserving representation used
+# for the projections) by rotation matrices R. The vectors have shape (...,n),
+# with n = 21 (elastic), 18 (piezoelectric) or 9 (lattice) according to shape0,
+# and R has shape (...,3,3); the leading dimensions are broadcast against each
+# other, so that a stack of tensors can be rotated by one rotation, one tensor by
+# a stack of rotations, etc.
+def rotate_vector_batch(vectors, R, shape0):
+ vectors = np.array(vectors, dtype=float)
+ R = np.array(R, dtype=float)
+ if shape0 == "elastic":
+  Q = get_mandel_rotation(R)
+  mandel = ela_vector_to_mandel(vectors)
+  return ela_mandel_to_vector(np.matmul(np.matmul(Q, mandel), np.swapaxes(Q, -1, -2)))
+ if shape0 == "piezoelectric":
+  Q = get_mandel_rotation(R)
+  mandel = vectors.reshape(vectors.shape[:-1] + (3,6))
+  rotated = np.matmul(np.matmul(R, mandel), np.swapaxes(Q, -1, -2))
+  return rotated.reshape(rotated.shape[:-2] + (18,))
+ if shape0 == "lattice":
+  cart = vectors.reshape(vectors.shape[:-1] + (3,3))
+  rotated = np.matmul(np.matmul(R, cart), np.swapaxes(R, -1, -2))
+  return rotated.reshape(rotated.shape[:-2] + (9,))
+##################################################################################
+# Returns the projector matrix for the given tensor shape ("elastic",
+# "piezoelectric" or "lattice") and symmetry. If a dtype is given (e.g.,
+# np.float32 for screening) the projector is returned in that precision and kept
+# in projector_cache, so that it is only built once
+projector_cache = {}
+def get_projector(shape0, sym = None, verbose = True, dtype = None):
+ if dtype is not None:
+  key = (shape0, sym, np.dtype(dtype).str)
+  if key not in projector_cache:
+   projector_cache[key] = get_projector(shape0, sym, verbose).astype(dtype)
+  return projector_cache[key]
+ if shape0 == "elastic":
+  return get_ela_projector(sym, verbose)
+ if shape0 == "piezoelectric":
+  return get_pz_projector(sym, verbose)
+ if shape0 == "lattice":
+  return get_lat_projector(sym, verbose)
+##################################################################################
+# Projects a stack of tensors in vector form, shape (...,n), onto the given
+# symmetry in one matrix product. The computation is done in double precision
+# unless a dtype is given
+def project_batch(vectors, sym, shape0, verbose = True, dtype = None):
+ if dtype is None:
+  projector = get_projector(shape0, sym, verbose)
+  return np.dot(np.array(vectors, dtype=float), projector.T)
+ projector = get_projector(shape0, sym, verbose, dtype)
+ return np.dot(np.asarray(vectors, dtype=dtype), projector.T)
+##################################################################################
+# Bounded memo of the rotations of one tensor (in vector form, see
+# rotate_vector_batch), used during the rotation optimization in ela_dist, pz_dist
+# and lat_dist. The rotated vectors are stored under the angle triple quantized to
+# a multiple of quantum (in degrees, well below the usual xtol), so that repeated
+# or nearly identical vertices of the simplex, and the same angles reached again
+# while scanning another symmetry, are rotated only once. The projectors are also
+# kept, so only the projection is repeated for each symmetry. When more than
+# maxsize rotations are stored the least recently used ones are dropped
+class RotationMemo:
+ def __init__(self, vector, shape0, maxsize = 10000, quantum = 1e-10):
+  from collections import OrderedDict
+  self.vector = np.array(vector, dtype=float)
+  self.shape0 = shape0
+  self.maxsize = maxsize
+  self.quantum = quantum
+  self.rotations = OrderedDict()
+  self.projectors = {}
+  self.hits = 0
+  self.misses = 0
+# Rotate method: returns the tensor rotated by angles t = [tx, ty, tz]
+ def rotate(self, t):
+  key = tuple(np.round(np.array(t, dtype=float) / self.quantum).astype(np.int64))
+  if key in self.rotations:
+   self.hits += 1
+   self.rotations.move_to_end(key)
+   return self.rotations[key]
+  self.misses += 1
+  if backend == "numba":
+   code = {"elastic": 0, "piezoelectric": 1, "lattice": 2}[self.shape0]
+   rotated = kernel_rotate_vector(np.array(key) * self.quantum, self.vector, code, *get_jit_data())
+  else:
+   R = rotation_matrix(np.array(key) * self.quantum)
+   rotated = rotate_vector_batch(self.vector, R, self.shape0)
+  self.rotations[key] = rotated
+  if len(self.rotations) > self.maxsize:
+   self.rotations.popitem(last = False)
+  return rotated
+# Projector method: returns the (stored) projector onto the given symmetry
+ def get_projector(self, sym, verbose = True):
+  if sym not in self.projectors:
+   self.projectors[sym] = get_projector(self.shape0, sym, verbose, np.float64)
+  return self.projectors[sym]
+# Project method: projects a vector onto the given symmetry
+ def project(self, vector, sym, verbose = True):
+  return np.dot(self.get_projector(sym, verbose), vector)
+##################################################################################
+# Returns a RotationMemo for the tensor in vector form, reusing the ones created
+# for the most recent tensors (up to maxsize of them are kept), so that repeated
+# calls of the residual functions without an explicit memo (e.g., from a
+# minimizer) share the stored rotations and projectors
+rotation_memos = {}
+def get_rotation_memo(vector, shape0, maxsize = 16):
+ vector = np.array(vector, dtype=float)
+ key = (shape0, vector.tobytes())
+ if key in rotation_memos:
+  rotation_memos[key] = rotation_memos.pop(key)
+  return rotation_memos[key]
+ memo = RotationMemo(vector, shape0)
+ rotation_memos[key] = memo
+ if len(rotation_memos) > maxsize:
+  rotation_memos.pop(next(iter(rotation_memos)))
+ return memo
+##################################################################################
+# Residual |(I-P).v(t)|^2 of a tensor rotated by angles t = [tx, ty, tz] with
+# respect to its projection onto the symmetry sym, expanded as a trigonometric
+# polynomial in the three angles. The entries of R = Rz.Ry.Rx are of degree 1 in
+# each angle, hence the residual is of degree K = 2*rank in each of them (8 for
+# elastic, 6 for piezoelectric and 4 for lattice tensors), and the (2K+1)^3
+# Fourier coefficients are obtained exactly from the residual sampled on a
+# uniform grid with one FFT. After that, evaluating the residual or its gradient
+# (with respect to the angles in degrees) at any angles, or on a whole uniform
+# grid of angles, does not require rotating the tensor again
+class ResidualPolynomial:
+ def __init__(self, vector, sym, shape0, verbose = True):
+  K = {"elastic": 8, "piezoelectric": 6, "lattice": 4}[shape0]
+  n = 2*K + 1
+  t = 360. * np.arange(0, n) / n
+  angles = np.stack(np.meshgrid(t, t, t, indexing="ij"), axis=-1).reshape(-1,3)
+  rotated = rotate_vector_batch(vector, rotation_matrix(angles), shape0)
+  res = rotated - np.dot(rotated, get_projector(shape0, sym, verbose).T)
+  values = np.sum(res**2, axis=-1).reshape(n,n,n)
+  self.shape0 = shape0
+  self.sym = sym
+  self.frequencies = np.arange(-K, K+1)
+  self.coefficients = np.fft.fftshift(np.fft.fftn(values)) / n**3
+# Exponentials exp(i k t) for the angles t (...,3) and frequencies -K,...,K
+ def get_exponentials(self, t):
+  t = np.radians(np.array(t, dtype=float))
+  return [np.exp(1j * self.frequencies * t[..., i, None]) for i in range(0,3)]
+# Evaluate method: residual at the angles t, one triple or a stack (...,3)
+ def evaluate(self, t):
+  ex, ey, ez = self.get_exponentials(t)
+  return np.real(np.einsum("klm,...k,...l,...m->...", self.coefficients, ex, ey, ez))
+# Gradient method: derivatives of the residual with respect to tx, ty and tz
+ def gradient(self, t):
+  ex, ey, ez = self.get_exponentials(t)
+  ik = 1j * self.frequencies * np.pi / 180.
+  dx = np.einsum("klm,...k,...l,...m->...", self.coefficients, ik*ex, ey, ez)
+  dy = np.einsum("klm,...k,...l,...m->...", self.coefficients, ex, ik*ey, ez)
+  dz = np.einsum("klm,...k,...l,...m->...", self.coefficients, ex, ey, ik*ez)
+  return np.real(np.stack([dx, dy, dz], axis=-1))
+# Grid method: residual on the uniform grid of npoints^3 angles 360*j/npoints
+# (npoints >= 2K+1), obtained with one inverse FFT. Returns the 1D array of
+# angles and the (npoints,npoints,npoints) array of residuals
+ def grid(self, npoints = 36):
+  npoints = max(npoints, len(self.frequencies))
+  index = self.frequencies % npoints
+  padded = np.zeros((npoints, npoints, npoints), dtype=complex)
+  padded[np.ix_(index, index, index)] = self.coefficients
+  values = np.real(np.fft.ifftn(padded)) * npoints**3
+  return 360. * np.arange(0, npoints) / npoints, values
+# Minimize method: global minimum of the residual, taking the best point of the
+# grid as starting point for a local minimization (requires Scipy). Returns the
+# optimal angles
+ def minimize(self, xtol = 1e-8, npoints = 36, disp = 0):
+  from scipy.optimize import fmin
+  t, values = self.grid(npoints)
+  i = np.unravel_index(np.argmin(values), values.shape)
+  t0 = [t[i[0]], t[i[1]], t[i[2]]]
+  return fmin(self.evaluate, x0=t0, xtol=xtol, disp=disp)
+##################################################################################
+# Residuals |(I-P).v(t)|^2 for a stack of angles t (M,3), with the tensor rotated
+# to all of them and projected in one batched call
+def res_batch(t, vector, sym, shape0, verbose = False):
+ rotated = rotate_vector_batch(vector, rotation_matrix(t), shape0)
+ res = rotated - project_batch(rotated, sym, shape0, verbose)
+ return np.sum(res**2, axis=-1)
+##################################################################################
+# Global minimization of the rotation residual by differential evolution
+# (rand/1/bin with mutation factor F and crossover probability CR). The whole
+# population of popsize angle triples is evaluated per generation with res_batch.
+# The search stops when the spread of the residuals in the population falls below
+# tolerance (relative to their mean) or after maxiter generations, and the best
+# member is then polished with fmin (requires Scipy). The random generator is
+# seeded (seed = 0 by default) so that the results are reproducible. Returns the
+# optimal angles
+def de_minimize(vector, sym, shape0, popsize = 30, tolerance = 1e-6, xtol = 1e-8, maxiter = 1000,
+                F = 0.8, CR = 0.9, seed = 0, verbose = False, disp = 0):
+ from scipy.optimize import fmin
+ rng = np.random.default_rng(seed)
+ popsize = max(popsize, 4)
+ population = rng.uniform(-180., 180., (popsize,3))
+ fitness = res_batch(population, vector, sym, shape0, verbose)
+ for generation in range(0,maxiter):
+  if np.std(fitness) <= tolerance * np.abs(np.mean(fitness)) + 1e-14:
+   break
+# Pick three distinct members other than the target for each target
+  choice = np.argsort(rng.random((popsize,popsize-1)), axis=1)[:, 0:3]
+  choice = choice + (choice >= np.arange(0,popsize)[:, None])
+  mutant = population[choice[:,0]] + F * (population[choice[:,1]] - population[choice[:,2]])
+  cross = rng.random((popsize,3)) < CR
+  cross[np.arange(0,popsize), rng.integers(0, 3, popsize)] = True
+  trial = np.where(cross, mutant, population)
+  trial = (trial + 180.) % 360. - 180.
+  trial_fitness = res_batch(trial, vector, sym, shape0, verbose)
+  better = trial_fitness <= fitness
+  population[better] = trial[better]
+  fitness[better] = trial_fitness[better]
+ memo = RotationMemo(vector, shape0)
+ def res(t):
+  rotated = memo.rotate(t)
+  r = rotated - memo.project(rotated, sym, verbose)
+  return np.dot(r,r)
+ return fmin(res, x0=population[np.argmin(fitness)], xtol=xtol, disp=disp)
+##################################################################################
+# Collects the vector form of a set of tensors into an (N,n) array. The input can
+# be a Tensor, a list of Tensor objects (all with the same shape and form) or an
+# array with a stack of tensors in Voigt notation ((N,6,6) elastic, (N,3,6)
+# piezoelectric), normalized vector form ((N,21), (N,18)) or lattice matrices
+# ((N,3,3)). For arrays in Voigt notation the form can be given (defaults are
+# "C" and "e"). Returns the shape ("elastic", "piezoelectric" or "lattice"), the
+# form and the array of vectors, in the given precision
+def get_vector_stack(tensors, form = None, dtype = float):
+ if isinstance(tensors, Tensor):
+  tensors = [tensors]
+ if len(tensors) > 0 and isinstance(tensors[0], Tensor):
+  shape0 = tensors[0].shape[0]
+  form = tensors[0].form
+  vectors = np.array([t.vector for t in tensors], dtype=dtype)
+  return shape0, form, vectors
+ tensors = np.asarray(tensors)
+ if not np.issubdtype(tensors.dtype, np.floating):
+  tensors = tensors.astype(float)
+ if tensors.shape[-2:] == (6,6):
+  shape0 = "elastic"
+  if form not in ["C", "S"]:
+   form = "C"
+  vectors = vectorize_ela_voigt_batch(tensors, form)
+ elif tensors.shape[-1] == 21:
+  shape0 = "elastic"
+  if form not in ["C", "S"]:
+   form = "C"
+  vectors = tensors
+ elif tensors.shape[-2:] == (3,6):
+  shape0 = "piezoelectric"
+  if form not in ["e", "d"]:
+   form = "e"
+  vectors = vectorize_pz_voigt_batch(tensors, form)
+ elif tensors.shape[-1] == 18:
+  shape0 = "piezoelectric"
+  if form not in ["e", "d"]:
+   form = "e"
+  vectors = tensors
+ elif tensors.shape[-2:] == (3,3) or tensors.shape[-1] == 9:
+  shape0 = "lattice"
+  form = None
+  vectors = tensors
+ else:
+  print_check_shape_error(True)
+  return None, None, None
+ n = {"elastic": 21, "piezoelectric": 18, "lattice": 9}[shape0]
+ return shape0, form, vectors.reshape(-1,n).astype(dtype, copy=False)
+##################################################################################
+# Format used to print the distances for each kind of tensor
+def get_printdist(shape0, form = None):
+ if shape0 == "elastic" and form == "S":
+  return "%9.2e 1/GPa"
+ return {"elastic": "%7.2f GPa", "piezoelectric": "%7.2f C/m^2", "lattice": "%7.4f Angst."}[shape0]
+##################################################################################
+# Default list of symmetries checked for each kind of tensor
+def get_default_symlist(shape0):
+ if shape0 == "piezoelectric":
+  return ["432", "-43m", "6", "-6", "622", "6mm", "-62m", "3", "32",
+          "3m", "-4", "-42m", "2", "222", "m", "-2", "mm2", "1"]
+ if shape0 == "elastic":
+  return ["iso", "cub", "hex", "3", "32", "4", "4mm", "ort", "mon"]
+ if shape0 == "lattice":
+  return ["hex"]
+##################################################################################
+# Distances without rotation optimization for a stack of tensors (anything
+# accepted by get_vector_stack), computed with one matrix product per symmetry.
+# Returns a list of [sym, edist], with edist an array of N distances. For
+# high-throughput screening the computation can be done in single precision
+# (dtype = np.float32), which halves memory and bandwidth. In that case, if a
+# threshold is given, the distances within a relative margin of the threshold
+# (i.e., those where the decision could depend on the precision) are recomputed
+# in double precision from the input data, and edist is returned in double
+# precision so that edist <= threshold is always the double precision decision
+def dist_batch(tensors, symlist = None, form = None, normalize = False, verbose = True,
+               dtype = float, threshold = None, margin = 1e-3):
+ shape0, form, vectors64 = get_vector_stack(tensors, form, float)
+ if shape0 is None:
+  return None
+ vectors = vectors64.astype(dtype, copy=False)
+ if symlist == None:
+  symlist = get_default_symlist(shape0)
+ result = []
+ for sym in symlist:
+  res = vectors - project_batch(vectors, sym, shape0, verbose, vectors.dtype)
+  edist2 = np.sum(res**2, axis=1)
+  if normalize:
+   edist2 = edist2 / np.sum(vectors**2, axis=1)
+  edist = np.sqrt(edist2)
+  if threshold is not None and vectors.dtype != np.float64:
+   edist = edist.astype(float)
+   recheck = np.nonzero(np.abs(edist - threshold) <= margin * np.abs(threshold))[0]
+   if len(recheck) > 0:
+    edist[recheck] = dist_batch(vectors64[recheck], [sym], form, normalize,
+                                verbose = False)[0][1]
+  result.append([sym, edist])
+ return result
+##################################################################################
 ##################################################################################
 ##### End of Tensor class and basic functions                                #####
 ##################################################################################
@@ -533,6 +1177,16 @@ def print_no_form_warning(verbose):
   print("************************** W A R N I N G **************************")
   print("                                                                   ")
 ##################################################################################
+def print_ela_form_warning(verbose):
+ if verbose:
+  print("                                                                   ")
+  print("************************** W A R N I N G **************************")
+  print("Warning! The form (keyword \"form\") of your elastic tensor should  ")
+  print("be either stiffness (form = \"C\") or compliance (form = \"S\"). I'm ")
+  print("using the stiffness form by default (form = \"C\").                ")
+  print("************************** W A R N I N G **************************")
+  print("                                                                   ")
+##################################################################################
 def print_pz_tensor_not_symmetric(verbose):
  if verbose:
   print("                                                                   ")
@@ -549,6 +1203,144 @@ def print_ela_tensor_not_symmetric(verbose):
   print("************************** W A R N I N G **************************")
   print("                                                                   ")
 ##################################################################################
+# Prints the lower bounds for the rotated distances obtained from the harmonic
+# decomposition of the tensor
+def print_harmonic_bounds(lower, printdist, verbose):
+ if verbose:
+  print("                                                                   ")
+  print("************************** R E S U L T S **************************")
+  print("Lower bounds from the harmonic decomposition (valid for any        ")
+  print("rotation, exact for isotropy)                                      ")
+  print("                                                                   ")
+  print("Symmetry     Lower bound                                           ")
+  print("--------     -----------                                           ")
+  for sym, bound in lower:
+   print(("%8s            " + printdist) % (sym, bound))
+  print("************************** R E S U L T S **************************")
+  print("                                                                   ")
+##################################################################################
+# Prints the distance results that were read from the cache instead of computed
+def print_cached_results(rows, printdist, verbose):
+ if verbose and len(rows) > 0:
+  print("                                                                   ")
+  print("************************** R E S U L T S **************************")
+  print("Results read from the distance cache                               ")
+  print("                                                                   ")
+  print("Symmetry     Euclidean distance     Angles tx,     ty,     tz      ")
+  print("--------     ------------------     -------------------------------")
+  for row in rows:
+   printangles = ""
+   if len(row) > 2:
+    printangles = "       %7.2f %7.2f %7.2f  deg." % (row[2], row[3], row[4])
+   print(("%8s            " + printdist + "%s") % (row[0], row[1], printangles))
+  print("************************** R E S U L T S **************************")
+  print("                                                                   ")
+##################################################################################
+def print_no_numba_warning(verbose):
+ if verbose:
+  print("                                                                   ")
+  print("************************** W A R N I N G **************************")
+  print("Warning! Numba is not available, the JIT-compiled kernels cannot  ")
+  print("be used. I'm using the NumPy backend instead.                      ")
+  print("************************** W A R N I N G **************************")
+  print("                                                                   ")
+##################################################################################
+def print_batch_mismatch_warning(directory, verbose):
+ if verbose:
+  print("                                                                   ")
+  print("************************** W A R N I N G **************************")
+  print("Warning! The directory %s contains a batch run with" % directory)
+  print("different settings or input tensors. I'm not touching it, use a    ")
+  print("different directory or remove the old one.                         ")
+  print("************************** W A R N I N G **************************")
+  print("                                                                   ")
+##################################################################################
+def print_batch_incomplete_warning(directory, verbose):
+ if verbose:
+  print("                                                                   ")
+  print("************************** W A R N I N G **************************")
+  print("Warning! The batch run in %s is not complete, the" % directory)
+  print("merged results only contain the chunks that are done.              ")
+  print("************************** W A R N I N G **************************")
+  print("                                                                   ")
+##################################################################################
+# Prints an error if two stacks of tensors that are combined one by one have
+# different lengths (other than one, which is used for all the others)
+def print_stack_length_error(n0, n1, verbose):
+ if verbose:
+  print("                                                                   ")
+  print("**************************** E R R O R ****************************")
+  print("The stacks of tensors you have given have different lengths (%i and" % n0)
+  print("%i). They must have the same length, or one of them must contain a" % n1)
+  print("single tensor.                                                     ")
+  print("**************************** E R R O R ****************************")
+  print("                                                                   ")
+##################################################################################
+# Prints the mean and standard deviation of the distances of a tensor with
+# uncertainties and, if available, the probability of each symmetry assignment
+def print_uncertainty_results(result, printdist, verbose):
+ if verbose:
+  print("                                                                   ")
+  print("************************** R E S U L T S **************************")
+  print("Distances with uncertainties (%i samples)" % len(result["distances"]))
+  print("                                                                   ")
+  print("Symmetry     Mean distance          Standard deviation    Prob.    ")
+  print("--------     -------------          ------------------    -----    ")
+  for i in range(0,len(result["symlist"])):
+   sym = result["symlist"][i]
+   probability = ""
+   if "probability" in result:
+    probability = "   %6.3f" % result["probability"][sym]
+   print(("%8s            " + printdist + "           " + printdist + "%s") \
+         % (sym, result["mean"][i], result["std"][i], probability))
+  if "probability" in result:
+   print("    none" + " "*51 + "%6.3f" % result["probability"][None])
+  print("************************** R E S U L T S **************************")
+  print("                                                                   ")
+##################################################################################
+# Prints the distances of several tensors at the orientation shared by all of
+# them (see joint_dist)
+def print_joint_results(result, shapes, normalize, verbose):
+ if verbose:
+  print("                                                                   ")
+  print("************************** R E S U L T S **************************")
+  print("Results of the joint rotation optimization                         ")
+  print("                                                                   ")
+  print("Tensor           Symmetry     Euclidean distance                   ")
+  print("------           --------     ------------------                   ")
+  for k in range(0,len(shapes)):
+   sym, edist = result["distances"][k]
+   if normalize:
+    print("%-13s    %8s            %9.2e" % (shapes[k], sym, edist))
+   else:
+    print("%-13s    %8s            %9.4f" % (shapes[k], sym, edist))
+  t = result["angles"]
+  print("                                                                   ")
+  print("Shared angles tx, ty, tz: %7.2f %7.2f %7.2f deg." % (t[0], t[1], t[2]))
+  print("Combined residual: %9.2e" % result["residual"])
+  print("************************** R E S U L T S **************************")
+  print("                                                                   ")
+##################################################################################
+# Prints the decisions taken while looking for the highest symmetry of a tensor
+def print_symmetry_log(log, result, printdist, verbose):
+ if verbose:
+  print("                                                                   ")
+  print("************************** R E S U L T S **************************")
+  print("Search for the highest symmetry within tolerance                   ")
+  print("                                                                   ")
+  print("Symmetry     Decision                                              ")
+  print("--------     --------                                              ")
+  for sym, status in log:
+   print("%8s     %s" % (sym, status))
+  print("                                                                   ")
+  if result is None:
+   print("No symmetry found within tolerance                                 ")
+  else:
+   print(("Highest symmetry: %s, distance " + printdist + " at angles %7.2f %7.2f %7.2f deg.") \
+         % tuple(result))
+  print("************************** R E S U L T S **************************")
+  print("                                                                   ")
+##################################################################################
 ##################################################################################
 ##### End of printing functions                                              #####
 ##################################################################################
@@ -592,8 +1384,128 @@ def lat_components_to_cartesian(e_components):
    k += 1
  return e_cart
 ##################################################################################
-# Projects onto a given reference lattice
-def project_lat(vector, sym = None, verbose = True):
+# Reduces a lattice matrix (lattice vectors as columns) to its Delaunay (Selling)
+# reduced cell. The superbase b0, b1, b2, b3 = -(b0+b1+b2) is transformed until
+# all the scalar products b_i.b_j are non-positive, then the shortest basis that
+# can be made of the seven Delaunay vectors b_i and b_i+b_j (the latter can be
+# as short as the b_i when some of the products vanish) is returned, sorted by
+# increasing length and right-handed.
+# Works on a single 3x3 matrix or on a stack of them with shape (N,3,3), all the
+# cells being reduced simultaneously. Returns the reduced cell(s) together with
+# the integer (unimodular) transformation(s) T such that reduced = e_cart . T.
+# Note that the reduction is a change of basis of the lattice (columns), whereas
+# the rotation search of lat_dist rotates the matrix as a rank-2 tensor (see
+# rotate_lat), and the two do not commute: reduction (followed by lat_setting)
+# recovers the distance of skewed cells given in the frame of the reference
+# lattice, but not that of cells that were also rotated with rotate_lat
+def reduce_lat(e_cart, tol = 1e-8, maxiter = 1000):
+ cells = np.array(e_cart, dtype=float)
+ single = (cells.ndim == 2)
+ if single:
+  cells = cells[None]
+ n = len(cells)
+# Superbase and its coefficients in terms of the original basis
+ extra = np.array([[-1.], [-1.], [-1.]])
+ coeff = np.concatenate([np.eye(3), extra], axis=1)
+ coeff = np.repeat(coeff[None], n, axis=0)
+ base = np.matmul(cells, coeff)
+# Selling transformation associated to each of the six (i,j) pairs: b_i -> -b_i
+# and b_k -> b_k + b_i for the two k not in (i,j)
+ pairs = [(i, j) for i in range(0,4) for j in range(i+1,4)]
+ selling = np.zeros((6,4,4))
+ for p, (i, j) in enumerate(pairs):
+  selling[p] = np.eye(4)
+  selling[p][i][i] = -1.
+  for k in range(0,4):
+   if k != i and k != j:
+    selling[p][i][k] = 1.
+ ip = np.array([pair[0] for pair in pairs])
+ jp = np.array([pair[1] for pair in pairs])
+ for it in range(0,maxiter):
+  gram = np.matmul(np.swapaxes(base, 1, 2), base)
+  scale = np.trace(gram, axis1=1, axis2=2) / 4.
+  g = gram[:, ip, jp]
+  active = g.max(axis=1) > tol * scale
+  if not active.any():
+   break
+  step = np.where(active[:, None, None], selling[g.argmax(axis=1)], np.eye(4))
+  base = np.matmul(base, step)
+  coeff = np.matmul(coeff, step)
+# The seven Delaunay vectors b0, b1, b2, b3, b0+b1, b0+b2 and b0+b3 (the other
+# sums are the same up to sign), and the triples of them that form a basis
+ delaunay = np.concatenate([np.eye(4), np.array([[1., 1., 1.], [1., 0., 0.], [0., 1., 0.],
+                                                 [0., 0., 1.]])], axis=1)
+ base = np.matmul(base, delaunay)
+ coeff = np.matmul(coeff, delaunay)
+ triples = np.array([[i, j, k] for i in range(0,7) for j in range(i+1,7) for k in range(j+1,7)])
+ dets = np.linalg.det(coeff[:, :, triples].transpose(0,2,1,3))
+ lengths = np.einsum("nki,nki->ni", base, base)
+ total = np.where(np.abs(np.abs(dets) - 1.) < 1e-6, lengths[:, triples].sum(axis=2), np.inf)
+ best = triples[np.argmin(total, axis=1)]
+ order = np.take_along_axis(best, np.argsort(np.take_along_axis(lengths, best, axis=1), axis=1,
+                                             kind="stable"), axis=1)
+ reduced = np.take_along_axis(base, order[:, None, :], axis=2)
+ transformation = np.take_along_axis(coeff, order[:, None, :], axis=2)
+# Make the basis right-handed
+ sign = np.sign(np.linalg.det(transformation))
+ reduced *= sign[:, None, None]
+ transformation = np.rint(transformation * sign[:, None, None]).astype(int)
+ if single:
+  return reduced[0], transformation[0]
+ return reduced, transformation
+##################################################################################
+# Brings lattice matrices (a single 3x3 one or a stack (N,3,3), lattice vectors
+# as columns), e.g., Delaunay reduced cells, into the setting expected by the
+# lattice projector of the given symmetry (for "hex", a1 and a2 at 120 degrees
+# and c perpendicular to them, as in get_lat_projector). Among the unimodular
+# transformations U with entries -1, 0 and 1, the one whose metric (U^T G U, with
+# G the metric of the cell) is closest to the metric of that setting is chosen,
+# ties (equivalent settings) being broken by the distance without rotation of the
+# transformed cell. For the symmetries without metric constraints the cells are
+# returned unchanged. Returns the cell(s) and the transformation(s) U such that
+# new = e_cart . U. The candidate transformations (the 3480 of them with
+# determinant 1, so that right-handed cells stay right-handed) are enumerated on
+# the first call and kept in lat_setting_candidates
+lat_setting_metrics = {"hex": [[[1., -0.5, 0.], [-0.5, 1., 0.], [0., 0., 0.]],
+                               [[0., 0., 0.], [0., 0., 0.], [0., 0., 1.]]]}
+lat_setting_candidates = []
+def lat_setting(e_cart, sym, verbose = True, chunksize = 100):
+ import itertools
+ cells = np.array(e_cart, dtype=float)
+ single = (cells.ndim == 2)
+ if single:
+  cells = cells[None]
+ n = len(cells)
+ key = sym
+ if sym in ["6", "-6", "6/m", "622", "6mm", "-62m", "6/mmm"]:
+  key = "hex"
+ transformation = np.repeat(np.eye(3, dtype=int)[None], n, axis=0)
+ if key in lat_setting_metrics:
+  if not lat_setting_candidates:
+   candidates = np.array(list(itertools.product([-1, 0, 1], repeat=9))).reshape(-1,3,3)
+   lat_setting_candidates.append(candidates[np.rint(np.linalg.det(candidates)) == 1])
+  candidates = lat_setting_candidates[0]
+# Orthonormal basis of the metrics of the setting, to project onto them
+  basis = np.array(lat_setting_metrics[key]).reshape(-1,9)
+  basis = np.linalg.qr(basis.T)[0].T
+  projector = get_projector("lattice", sym, verbose)
+  for i in range(0, n, chunksize):
+   new = np.matmul(cells[i:i+chunksize, None], candidates[None])
+   gram = np.matmul(np.swapaxes(new, -1, -2), new).reshape(new.shape[:2] + (9,))
+   mismatch = np.sum((gram - np.dot(np.dot(gram, basis.T), basis))**2, axis=-1)
+   mismatch = mismatch / np.sum(gram**2, axis=-1)
+   v = new.reshape(new.shape[:2] + (9,))
+   dist = np.sum((v - np.dot(v, projector.T))**2, axis=-1)
+   score = np.where(mismatch <= mismatch.min(axis=1)[:, None] + 1e-10, dist, np.inf)
+   transformation[i:i+chunksize] = candidates[np.argmin(score, axis=1)]
+  cells = np.matmul(cells, transformation)
+ if single:
+  return cells[0], transformation[0]
+ return cells, transformation
+##################################################################################
+# Builds the projector onto a given reference lattice (matrix acting on the
+# 9-component vector form of the lattice matrix)
+def get_lat_projector(sym = None, verbose = True):
 # Available classes and point groups ("iso" does not apply here)
  classes = ["cub", "hex", "hex60", "rho", "tig", "tet", "ort", "mon", "tic"]
  pointgroups = ["23", "m-3", "432", "-43m", "m-3m", "6", "-6", "6/m",
@@ -687,11 +1599,27 @@ def project_lat(vector, sym = None, verbose = True):
   c1 = 1.
   for i in range(0,9):
    projector[i][i] = c1
+ return projector
+##################################################################################
+# Projects onto a given reference lattice
+def project_lat(vector, sym = None, verbose = True, dtype = None):
+ if dtype is not None:
+  return np.dot(get_projector("lattice", sym, verbose, dtype), np.asarray(vector, dtype=dtype))
+ projector = get_lat_projector(sym, verbose)
 # Carry out the projection
  proj=np.dot(projector,vector)
  return proj
 ##################################################################################
-def res_lat(t, vector, sym = None, verbose = False):
+def res_lat(t, vector, sym = None, verbose = False, memo = None):
+ if backend == "numba":
+  if memo is None:
+   memo = get_rotation_memo(vector, "lattice")
+  return kernel_residual(np.array(t, dtype=float), memo.vector, memo.get_projector(sym, verbose), 2,
+                         *get_jit_data())
+ if memo is not None:
+  rot_vector = memo.rotate(t)
+  res = rot_vector - memo.project(rot_vector, sym, verbose)
+  return np.dot(res,res)
  tx=t[0] ; ty=t[1] ; tz=t[2]
  c_cart=lat_components_to_cartesian(vector)
  rot_c=rotate_lat(c_cart,[tx,ty,tz])
@@ -702,9 +1630,15 @@ def res_lat(t, vector, sym = None, verbose = False):
  return result
 ##################################################################################
 # <---------------------------------- FIX THIS. THE SYMLIST SHOULD CONTAIN ALL OF THEM
+# The method, popsize and tolerance options are the same as in ela_dist. With
+# setting = True (used for reduced cells) the lattice matrix is brought into the
+# setting of each symmetry before the projection (see lat_setting; note that with
+# rotate = True this does not undo the reduction of cells rotated with rotate_lat,
+# see reduce_lat). The dtype option is the same as in ela_dist
 def lat_dist(vector,
              symlist = ["hex"],
-             rotate = False, xtol = 1e-8, verbose = True, printmin = False, normalize=False):
+             rotate = False, xtol = 1e-8, verbose = True, printmin = False, normalize=False,
+             method = "fmin", popsize = 30, tolerance = 1e-6, setting = False, dtype = None):
  from scipy.optimize import fmin
  disp = 0
  if printmin:
@@ -719,8 +1653,11 @@ def lat_dist(vector,
    print("Symmetry     Euclidean distance                                    ")
    print("--------     ------------------                                    ")
   for sym in symlist:
-   v = vector.copy()
-   vp = project_lat(v, sym)
+   v = np.array(vector, dtype=float)
+   if setting:
+    v = lat_setting(v.reshape(3,3), sym, verbose)[0].flatten()
+   v = np.asarray(v, dtype=dtype)
+   vp = project_lat(v, sym, dtype=dtype)
    if normalize:
     edist2 = np.dot(v-vp,v-vp) / np.dot(v,v)
    else:
@@ -740,13 +1677,23 @@ def lat_dist(vector,
    print("                                                                   ")
    print("Symmetry     Euclidean distance     Angles tx,     ty,     tz      ")
    print("--------     ------------------     -------------------------------")
+  cell = np.array(vector, dtype=float).reshape(3,3)
+  memo = RotationMemo(vector, "lattice")
   for sym in symlist:
+   if setting:
+    vector = lat_setting(cell, sym, verbose)[0].flatten()
+    memo = RotationMemo(vector, "lattice")
    topt = [0., 0., 0.]
-   topt = fmin(res_lat, x0=[0,0,0], xtol=xtol, args=(vector, sym, verbose), disp=disp)
-   ct = lat_components_to_cartesian(vector)
-   rotct = rotate_lat(ct, topt)
-   v = np.array(rotct).flatten()
-   vp = project_lat(v, sym = sym, verbose=False)
+   if method == "poly":
+    topt = ResidualPolynomial(vector, sym, "lattice", verbose).minimize(xtol, disp=disp)
+   elif method == "de":
+    topt = de_minimize(vector, sym, "lattice", popsize, tolerance, xtol, verbose=verbose, disp=disp)
+   else:
+    topt = fmin(res_lat, x0=[0,0,0], xtol=xtol, args=(vector, sym, verbose, memo), disp=disp)
+   v = memo.rotate(topt)
+   vp = memo.project(v, sym, verbose=False)
+   if dtype is not None:
+    v = np.asarray(v, dtype=dtype) ; vp = project_batch(v, sym, "lattice", False, dtype)
    if normalize:
     edist2 = np.dot(v-vp,v-vp) / np.dot(v,v)
    else:
@@ -762,6 +1709,36 @@ def lat_dist(vector,
    print("                                                                   ")
  return result
 ##################################################################################
+# Batched version of lat_dist without rotation optimization. The cells are given
+# as a stack of lattice matrices with shape (N,3,3) and all of them are projected
+# at once for each symmetry. Optionally the cells are Delaunay reduced first (see
+# reduce_lat), in which case the transformations used are also returned, i.e.,
+# the function returns "result, transformation" instead of "result", and the
+# reduced cells are brought into the setting of each symmetry before they are
+# projected (see lat_setting). Each entry
+# of result is [sym, edist], with edist an array of N distances. The projection
+# can be done in single precision with dtype = np.float32
+def lat_dist_batch(cells,
+                   symlist = ["hex"],
+                   reduce = False, tol = 1e-8, verbose = True, normalize = False, dtype = float):
+ cells = np.array(cells, dtype=float).reshape(-1,3,3)
+ if reduce:
+  cells, transformation = reduce_lat(cells, tol = tol)
+ result = []
+ for sym in symlist:
+  v = cells.reshape(-1,9).astype(dtype)
+  if reduce:
+   v = lat_setting(cells, sym, verbose)[0].reshape(-1,9).astype(dtype)
+  projector = get_projector("lattice", sym, verbose, v.dtype)
+  vp = np.dot(v, projector.T)
+  edist2 = np.sum((v-vp)**2, axis=1)
+  if normalize:
+   edist2 /= np.sum(v**2, axis=1)
+  result.append([sym, np.sqrt(edist2)])
+ if reduce:
+  return result, transformation
+ return result
+##################################################################################
 ##################################################################################
 ##################################################################################
 ##### End of functions for lattice matrix manipulation                       #####
@@ -830,7 +1807,10 @@ def pz_voigt_to_cartesian(e_voigt, form):
     if form == "e":
      level2.append(e_voigt[i_voigt][j_voigt])
     if form == "d":
-     level2.append(e_voigt[i_voigt][j_voigt]/2.)
+     if j == k:
+      level2.append(e_voigt[i_voigt][j_voigt])
+     else:
+      level2.append(e_voigt[i_voigt][j_voigt]/2.)
    level1.append(level2)
   level0.append(level1)
  return level0
@@ -855,12 +1835,17 @@ def pz_cartesian_to_voigt(e_cart, form):
     if form == "e":
      level1.append(e_cart[i][j][k])
     if form == "d":
-     level1.append(2.*e_cart[i][j][k])
+     if j == k:
+      level1.append(e_cart[i][j][k])
+     else:
+      level1.append(2.*e_cart[i][j][k])
   level0.append(level1)
  return level0
 ##################################################################################
 # Performs a rotation operation on a (Cartesian) rank-3 tensor
 def rotate_pz(e_cart,rot_angles):
+ if backend == "numba":
+  return kernel_rotate_cart3(np.array(e_cart, dtype=float), rotation_matrix(rot_angles))
  f = np.pi / 180.
  result=np.zeros((3,3,3))
  tx=f*rot_angles[0] ; ty=f*rot_angles[1] ; tz=f*rot_angles[2]
@@ -879,8 +1864,11 @@ def rotate_pz(e_cart,rot_angles):
     result[i][j][k]=temp
  return result
 ##################################################################################
-# Projects onto a piezoelectric tensor (tensor in vector form)
-def project_pz(vector_e_voigt, sym = None, verbose = True):
+# Builds the projector onto a piezoelectric tensor of given symmetry (matrix
+# acting on the 18-component vector form of the tensor)
+pz_defaultpg = {"cub": "-43m", "hex": "6mm", "tig": "3m", "tet": "4mm", "ort" :"222", "mon": "2",
+                "tic": "1"}
+def get_pz_projector(sym = None, verbose = True):
 # Available classes, non centrosymmetric point groups and centrosymmetric point groups
  classes = ["iso", "cub", "hex", "tig", "tet", "ort", "mon", "tic"]
  ncspointgroups = ["23", "432", "-43m", "6", "-6",
@@ -942,7 +1930,7 @@ def project_pz(vector_e_voigt, sym = None, verbose = True):
 # point group compatible with that class will be assigned when the class
 # has more than one independent form for the piezoelectric tensor (i.e. the two
 # forms differ by more than modulo a rotation)
- defaultpg = {"cub": "-43m", "hex": "6mm", "tig": "3m", "tet": "4mm", "ort" :"222", "mon": "2", "tic": "1"}
+ defaultpg = pz_defaultpg
  if defaultpg.get(sym):
   oldsym = sym
   sym = defaultpg[oldsym]
@@ -1054,7 +2042,7 @@ def project_pz(vector_e_voigt, sym = None, verbose = True):
   projector[3][3] = c1 ; projector[5][5] = c1 ; projector[6][6] = c1
   projector[7][7] = c1 ; projector[8][8] = c1 ; projector[10][10] = c1
   projector[15][15] = c1 ; projector[17][17] = c1
- if sym == "m":
+ if sym == "m" or sym == "-2":
   c1 = 1.
   projector[0][0] = c1 ; projector[1][1] = c1 ; projector[2][2] = c1
   projector[4][4] = c1 ; projector[9][9] = c1 ; projector[11][11] = c1
@@ -1065,13 +2053,29 @@ def project_pz(vector_e_voigt, sym = None, verbose = True):
   c1 = 1.
   for i in range(0,18):
    projector[i][i] = c1
+ return projector
+##################################################################################
+# Projects onto a piezoelectric tensor (tensor in vector form)
+def project_pz(vector_e_voigt, sym = None, verbose = True, dtype = None):
+ if dtype is not None:
+  return np.dot(get_projector("piezoelectric", sym, verbose, dtype), np.asarray(vector_e_voigt, dtype=dtype))
+ projector = get_pz_projector(sym, verbose)
 # Carry out the projection
  proj=np.dot(projector,vector_e_voigt)
  return proj
 ##################################################################################
 # Creates the function to be minimized for an input PZ tensor
 # given in Voigt notation, in terms of the rotation angles
-def res_pz(t, e_voigt, sym = None, form = None, verbose = True):
+def res_pz(t, e_voigt, sym = None, form = None, verbose = True, memo = None):
+ if backend == "numba":
+  if memo is None:
+   memo = get_rotation_memo(vectorize_pz_voigt(e_voigt, form = form), "piezoelectric")
+  return kernel_residual(np.array(t, dtype=float), memo.vector, memo.get_projector(sym, verbose), 1,
+                         *get_jit_data())
+ if memo is not None:
+  rot_vector = memo.rotate(t)
+  res = rot_vector - memo.project(rot_vector, sym, verbose)
+  return np.dot(res,res)
  tx=t[0] ; ty=t[1] ; tz=t[2]
  e_cart=pz_voigt_to_cartesian(e_voigt, form = form)
  rot_e=rotate_pz(e_cart,[tx,ty,tz])
@@ -1090,11 +2094,16 @@ def res_pz(t, e_voigt, sym = None, form = None, verbose = True):
 # with and without rotation optimization. Setting printmin = True will print
 # the info from the minimization routine. The list of symmetries to check is
 # complete by default. The user can override this if they're only interested
-# in a reduced set. This function requires Scipy.
+# in a reduced set. With method = "poly" the rotation optimization starts from the
+# global minimum on a grid of angles (see ResidualPolynomial) instead of from
+# zero angles. With method = "de" a global search by differential evolution
+# with the given population size and tolerance is done (see de_minimize). The
+# dtype option is the same as in ela_dist. This function requires Scipy.
 def pz_dist(e_voigt, form = None,
             symlist = ["432", "-43m", "6", "-6", "622", "6mm", "-62m", "3", "32", "3m",
                        "-4", "-42m", "2", "222", "m", "-2", "mm2", "1"],
-            rotate = False, xtol = 1e-8, verbose = True, printmin = False, normalize=False):
+            rotate = False, xtol = 1e-8, verbose = True, printmin = False, normalize=False,
+            bounds = False, method = "fmin", popsize = 30, tolerance = 1e-6, dtype = None):
  from scipy.optimize import fmin
  cspointgroups = ["m-3", "m-3m", "6/m", "6/mmm", "-3", "-3m", "4/m", "4/mmm", "2/m", "mmm", "-1"]
  disp = 0
@@ -1122,8 +2131,8 @@ def pz_dist(e_voigt, form = None,
    print("Symmetry     Euclidean distance                                    ")
    print("--------     ------------------                                    ")
   for sym in symlist:
-   v = vectorize_pz_voigt(e_voigt, form = form)
-   vp = project_pz(v, sym)
+   v = np.asarray(vectorize_pz_voigt(e_voigt, form = form), dtype=dtype)
+   vp = project_pz(v, sym, dtype=dtype)
    if normalize:
     edist2 = np.dot(v-vp,v-vp) / np.dot(v,v)
    else:
@@ -1143,15 +2152,21 @@ def pz_dist(e_voigt, form = None,
    print("                                                                   ")
    print("Symmetry     Euclidean distance     Angles tx,     ty,     tz      ")
    print("--------     ------------------     -------------------------------")
+  memo = RotationMemo(vectorize_pz_voigt(e_voigt, form = form), "piezoelectric")
   for sym in symlist:
    topt = [0., 0., 0.]
    if sym != "iso" or sym not in cspointgroups:
-    topt = fmin(res_pz, x0=[0,0,0], xtol=xtol, args=(e_voigt, sym, form, verbose), disp=disp)
-   et = pz_voigt_to_cartesian(e_voigt, form = form)
-   rotet = rotate_pz(et, topt)
-   rot_voigt = pz_cartesian_to_voigt(rotet, form = form)
-   v = vectorize_pz_voigt(rot_voigt, form = form)
-   vp = project_pz(v, sym = sym, verbose=False)
+    if method == "poly":
+     topt = ResidualPolynomial(memo.vector, sym, "piezoelectric", verbose).minimize(xtol, disp=disp)
+    elif method == "de":
+     topt = de_minimize(memo.vector, sym, "piezoelectric", popsize, tolerance, xtol, verbose=verbose,
+                        disp=disp)
+    else:
+     topt = fmin(res_pz, x0=[0,0,0], xtol=xtol, args=(e_voigt, sym, form, verbose, memo), disp=disp)
+   v = memo.rotate(topt)
+   vp = memo.project(v, sym, verbose=False)
+   if dtype is not None:
+    v = np.asarray(v, dtype=dtype) ; vp = project_batch(v, sym, "piezoelectric", False, dtype)
    if normalize:
     edist2 = np.dot(v-vp,v-vp) / np.dot(v,v)
    else:
@@ -1174,8 +2189,125 @@ def pz_dist(e_voigt, form = None,
   if verbose:
    print("************************** R E S U L T S **************************")
    print("                                                                   ")
+# Lower bounds from the harmonic decomposition (no optimization needed)
+ if bounds:
+  lower = harmonic_bounds(vectorize_pz_voigt(e_voigt, form = form), "piezoelectric", symlist, normalize)
+  for i in range(0,len(result)):
+   result[i].append(lower[i][1])
+  print_harmonic_bounds(lower, "%7.2f C/m^2", verbose)
  return result
 ##################################################################################
+# Computes directional piezoelectric responses for an (M,3) array of directions n
+# from the Cartesian tensor(s), a single one (3x3x3) or a stack (N,3,3,3), in one
+# vectorized contraction. For e_ij (d_ij) form these are the longitudinal
+# coefficient e33(n) = e_ijk n_i n_j n_k, i.e., e33 (d33) in a frame whose z axis
+# is along n, the transverse coefficient e31(n,m) = e_ijk n_i m_j m_k and the
+# shear coefficient e15(n,m) = e_ijk m_i m_j n_k, the last two sampled over nperp
+# directions m perpendicular to n (minimum and maximum over m are returned).
+# The maximum of the longitudinal response over the given directions is also
+# returned, together with the direction where it happens and the rotation angles
+# (tx, ty, tz = 0, as used by rotate_pz) that bring that direction onto the z
+# axis. With refine = True the maximum is refined locally with respect to the
+# angles, starting from the best direction on the mesh. This requires Scipy.
+def pz_directional(e_cart, directions, nperp = 36, refine = False, xtol = 1e-8):
+ e_cart = np.array(e_cart, dtype=float)
+ n = np.array(directions, dtype=float).reshape(-1,3)
+ n = n / np.linalg.norm(n, axis=1)[:, None]
+ m = perpendicular_directions(n, nperp)
+ en = np.einsum("...ijk,ai->...ajk", e_cart, n)
+ longitudinal = np.einsum("...ajk,aj,ak->...a", en, n, n)
+ transverse = np.einsum("...ajk,abj,abk->...ab", en, m, m)
+ shear = np.einsum("...ijk,abi,abj,ak->...ab", e_cart, m, m, n, optimize=True)
+ best = longitudinal.argmax(axis=-1)
+ maxdir = n[best]
+ maxval = longitudinal.max(axis=-1)
+ angles = np.stack([np.degrees(np.arctan2(maxdir[..., 1], maxdir[..., 2])),
+                    np.degrees(-np.arcsin(np.clip(maxdir[..., 0], -1., 1.))),
+                    np.zeros(maxval.shape)], axis=-1)
+ if refine:
+  from scipy.optimize import fmin
+  tensors = e_cart.reshape(-1,3,3,3)
+  flat_angles = angles.reshape(-1,3)
+  flat_dir = maxdir.reshape(-1,3)
+  flat_val = maxval.reshape(-1)
+  for i in range(0,len(tensors)):
+   topt = fmin(res_pz_longitudinal, x0=flat_angles[i][0:2], xtol=xtol, args=(tensors[i],), disp=0)
+   flat_angles[i] = [topt[0], topt[1], 0.]
+   flat_dir[i] = get_angles_direction(topt)
+   flat_val[i] = -res_pz_longitudinal(topt, tensors[i])
+  angles = flat_angles.reshape(angles.shape)
+  maxdir = flat_dir.reshape(maxdir.shape)
+  maxval = flat_val.reshape(maxval.shape)
+ result = {"longitudinal": longitudinal,
+           "transverse_min": transverse.min(axis=-1), "transverse_max": transverse.max(axis=-1),
+           "shear_min": shear.min(axis=-1), "shear_max": shear.max(axis=-1),
+           "max_longitudinal": maxval, "max_direction": maxdir, "max_angles": angles}
+ return result
+##################################################################################
+# Direction that the rotation with angles tx, ty (and any tz) brings onto the
+# z axis, i.e., the last row of the rotation matrix used by rotate_pz
+def get_angles_direction(t):
+ f = np.pi / 180.
+ tx = f*t[0] ; ty = f*t[1]
+ return np.array([-np.sin(ty), np.cos(ty)*np.sin(tx), np.cos(ty)*np.cos(tx)])
+##################################################################################
+# Function to be minimized to find the direction of maximum longitudinal
+# piezoelectric response, in terms of the rotation angles tx and ty
+def res_pz_longitudinal(t, e_cart):
+ n = get_angles_direction(t)
+ return -np.einsum("ijk,i,j,k->", e_cart, n, n, n)
+##################################################################################
+# Batched versions of vectorize_pz_voigt and tensorize_pz_voigt, for a single
+# 3x6 tensor or stacks (...,3,6) of them (vectors with shape (...,18))
+def vectorize_pz_voigt_batch(e_voigt, form):
+ coeff = np.ones(6)
+ if form == "e":
+  coeff[3:] = np.sqrt(2.)
+ if form == "d":
+  coeff[3:] = 1./np.sqrt(2.)
+ vectors = np.array(e_voigt, dtype=float) * coeff
+ return vectors.reshape(vectors.shape[:-2] + (18,))
+def tensorize_pz_voigt_batch(vector_e_voigt, form):
+ coeff = np.ones(6)
+ if form == "e":
+  coeff[3:] = np.sqrt(2.)
+ if form == "d":
+  coeff[3:] = 1./np.sqrt(2.)
+ vectors = np.array(vector_e_voigt, dtype=float)
+ return vectors.reshape(vectors.shape[:-1] + (3,6)) / coeff
+##################################################################################
+# Converts piezoelectric tensors between the d and e forms with the companion
+# elastic tensors, e_iJ = d_iK C_KJ and d_iJ = e_iK S_KJ. In vector form (where
+# the piezoelectric tensor is a 3x6 matrix in Kelvin notation) these are plain
+# matrix products with the Kelvin (Mandel) elastic matrices, all the tensors
+# being converted with one batched matmul. The piezoelectric and elastic inputs
+# are anything accepted by get_vector_stack (Tensor objects, Voigt stacks, etc.)
+# with matching lengths, or one of them a single tensor. The elastic tensor can
+# be in either C or S form, it is inverted if needed. formout is the target form
+# (the other one by default). The result is multiplied by factor, which takes
+# care of the units, e.g., factor = 1e-3 for d in pC/N and C in GPa giving e in
+# C/m^2, and factor = 1e3 for e in C/m^2 and S in 1/GPa giving d in pC/N. Returns
+# an (N,3,6) stack in Voigt notation
+def convert_pz_batch(piezo, elastic, formout = None, piezo_form = None, elastic_form = None,
+                     factor = 1., verbose = True):
+ shape0, piezo_form, pz_vectors = get_vector_stack(piezo, piezo_form)
+ shape1, elastic_form, ela_vectors = get_vector_stack(elastic, elastic_form)
+ if shape0 != "piezoelectric" or shape1 != "elastic":
+  print_check_shape_error(verbose)
+  return None
+ if len(pz_vectors) != len(ela_vectors) and 1 not in [len(pz_vectors), len(ela_vectors)]:
+  print_stack_length_error(len(pz_vectors), len(ela_vectors), verbose)
+  return None
+ if formout not in ["e", "d"]:
+  formout = {"e": "d", "d": "e"}[piezo_form]
+ if formout == piezo_form:
+  return tensorize_pz_voigt_batch(pz_vectors, piezo_form) * factor
+ mandel = ela_vector_to_mandel(ela_vectors)
+ if (formout == "e") != (elastic_form == "C"):
+  mandel = np.linalg.inv(mandel)
+ converted = np.matmul(pz_vectors.reshape(-1,3,6), mandel) * factor
+ return tensorize_pz_voigt_batch(converted.reshape(-1,18), formout)
+##################################################################################
 ##################################################################################
 ############# End of functions for piezoelectric tensor manipulation #############
 ##################################################################################
@@ -1189,9 +2321,44 @@ def pz_dist(e_voigt, form = None,
 ####### All the functions for manipulation of stiffness tensors are below  #######
 ##################################################################################
 ##################################################################################
+# Factor that takes a shear (i >= 3) row or column of the elastic tensor in Voigt
+# notation to Kelvin (Mandel) notation. The stiffness (form = "C") and compliance
+# (form = "S") Voigt conventions differ: S_44 = 4 S_2323 whereas C_44 = C_2323
+def get_ela_shear_factor(form = "C"):
+ if form == "S":
+  return 1./np.sqrt(2.)
+ return np.sqrt(2.)
+##################################################################################
+# Turns elastic tensor(s) in Voigt notation into Kelvin (Mandel) notation, where
+# the 6x6 matrix represents the tensor as an orthonormal-basis operator. Works
+# with a single 6x6 matrix or with stacks of them, shape (...,6,6)
+def ela_voigt_to_mandel(c_voigt, form = "C"):
+ w = np.ones(6)
+ w[3:] = get_ela_shear_factor(form)
+ return np.array(c_voigt, dtype=float) * np.outer(w, w)
+##################################################################################
+# Inverse of ela_voigt_to_mandel
+def ela_mandel_to_voigt(c_mandel, form = "C"):
+ w = np.ones(6)
+ w[3:] = get_ela_shear_factor(form)
+ return np.array(c_mandel, dtype=float) / np.outer(w, w)
+##################################################################################
+# Converts between stiffness and compliance forms of the elastic tensor, i.e.,
+# S = C^-1 and C = S^-1, with the correct Voigt factors. The input is a single
+# 6x6 Voigt matrix or a stack of them (...,6,6) in the given form and the output
+# has the same shape and is in the other form. All the matrices are inverted in
+# one call in Kelvin notation
+def invert_ela_voigt(c_voigt, form = "C"):
+ if form == "S":
+  formout = "C"
+ else:
+  formout = "S"
+ mandel = np.linalg.inv(ela_voigt_to_mandel(c_voigt, form))
+ return ela_mandel_to_voigt(mandel, formout)
+##################################################################################
 # Turns elastic tensor in Voigt notation to vector (preserving the norm)
 # it also symmetrizes the tensor in case it's not already symmetric
-def vectorize_ela_voigt(c_voigt):
+def vectorize_ela_voigt(c_voigt, form = "C"):
  result=[]
  for i in range(0,6):
   for j in range(i,6):
@@ -1199,14 +2366,14 @@ def vectorize_ela_voigt(c_voigt):
    if i != j:
     coeff *= np.sqrt(2.)
    if i >= 3:
-    coeff *= np.sqrt(2.)
+    coeff *= get_ela_shear_factor(form)
    if j >= 3:
-    coeff *= np.sqrt(2.)
+    coeff *= get_ela_shear_factor(form)
    result.append(coeff*(c_voigt[i][j]+c_voigt[j][i])/2.)
  return result
 ##################################################################################
 # Turns elastic vector (assumed to preserve the norm) to tensor in Voigt notation
-def tensorize_ela_voigt(vector_c_voigt):
+def tensorize_ela_voigt(vector_c_voigt, form = "C"):
  level0 = []
  for i in range(0,6):
   level1=[]
@@ -1225,15 +2392,16 @@ def tensorize_ela_voigt(vector_c_voigt):
    if i != j:
     coeff *= np.sqrt(2.)
    if i >= 3:
-    coeff *= np.sqrt(2.)
+    coeff *= get_ela_shear_factor(form)
    if j >= 3:
-    coeff *= np.sqrt(2.)
+    coeff *= get_ela_shear_factor(form)
    level1.append(vector_c_voigt[k]/coeff)
   level0.append(level1)
  return level0
 ##################################################################################
-# Transforms elastic tensor in Voigt notation to Cartesian notation
-def ela_voigt_to_cartesian(c_voigt):
+# Transforms elastic tensor in Voigt notation to Cartesian notation (in compliance
+# form each shear Voigt index carries a factor of 2)
+def ela_voigt_to_cartesian(c_voigt, form = "C"):
  level0=[]
  for i in range(0,3):
   level1=[]
@@ -1260,14 +2428,20 @@ def ela_voigt_to_cartesian(c_voigt):
        j_voigt=4
       elif (k == 0 and l == 1) or (l == 0 and k == 1):
        j_voigt=5
-     level3.append(c_voigt[i_voigt][j_voigt])
+     coeff = 1.
+     if form == "S":
+      if i_voigt >= 3:
+       coeff /= 2.
+      if j_voigt >= 3:
+       coeff /= 2.
+     level3.append(coeff*c_voigt[i_voigt][j_voigt])
     level2.append(level3)
    level1.append(level2)
   level0.append(level1)
  return level0
 ##################################################################################
 # Transforms elastic tensor in Cartesian notation to Voigt notation
-def ela_cartesian_to_voigt(c_cart):
+def ela_cartesian_to_voigt(c_cart, form = "C"):
  level0=[]
  for i_voigt in range(0,6):
   level1=[]
@@ -1292,12 +2466,20 @@ def ela_cartesian_to_voigt(c_cart):
       k=0 ; l=2
      elif j_voigt == 5:
       k=0 ; l=1
-    level1.append(c_cart[i][j][k][l])
+    coeff = 1.
+    if form == "S":
+     if i_voigt >= 3:
+      coeff *= 2.
+     if j_voigt >= 3:
+      coeff *= 2.
+    level1.append(coeff*c_cart[i][j][k][l])
   level0.append(level1)
  return level0
 ##################################################################################
 # Performs a rotation operation on a (Cartesian) rank-4 tensor
 def rotate_ela(c_cart, rot_angles):
+ if backend == "numba":
+  return kernel_rotate_cart4(np.array(c_cart, dtype=float), rotation_matrix(rot_angles))
  f = np.pi / 180.
  result=np.zeros((3,3,3,3))
  tx=f*rot_angles[0] ; ty=f*rot_angles[1] ; tz=f*rot_angles[2]
@@ -1318,8 +2500,9 @@ def rotate_ela(c_cart, rot_angles):
      result[i][j][k][l]=temp
  return result
 ##################################################################################
-# Projects onto an elastic tensor (tensor in vector form)
-def project_ela(vector_c_voigt, sym = None, verbose = True):
+# Builds the projector onto an elastic tensor of given symmetry (matrix acting on
+# the 21-component vector form of the tensor)
+def get_ela_projector(sym = None, verbose = True):
 # Available classes and point groups
  classes = ["iso", "cub", "hex", "tig", "tet", "ort", "mon", "tic"]
  pointgroups = ["23", "m-3", "432", "-43m", "m-3m", "6", "-6", "6/m",
@@ -1498,18 +2681,34 @@ def project_ela(vector_c_voigt, sym = None, verbose = True):
   c1 = 1.
   for i in range(0,21):
    projector[i][i] = c1
+ return projector
+##################################################################################
+# Projects onto an elastic tensor (tensor in vector form)
+def project_ela(vector_c_voigt, sym = None, verbose = True, dtype = None):
+ if dtype is not None:
+  return np.dot(get_projector("elastic", sym, verbose, dtype), np.asarray(vector_c_voigt, dtype=dtype))
+ projector = get_ela_projector(sym, verbose)
 # Carry out the projection
  proj=np.dot(projector,vector_c_voigt)
  return proj
 ##################################################################################
 # Creates the function to be minimized for an input elastic tensor
 # given in Voigt notation, in terms of the rotation angles
-def res_ela(t, c_voigt, sym = None, verbose = False):
+def res_ela(t, c_voigt, sym = None, verbose = False, form = "C", memo = None):
+ if backend == "numba":
+  if memo is None:
+   memo = get_rotation_memo(vectorize_ela_voigt(c_voigt, form), "elastic")
+  return kernel_residual(np.array(t, dtype=float), memo.vector, memo.get_projector(sym, verbose), 0,
+                         *get_jit_data())
+ if memo is not None:
+  rot_vector = memo.rotate(t)
+  res = rot_vector - memo.project(rot_vector, sym, verbose)
+  return np.dot(res,res)
  tx=t[0] ; ty=t[1] ; tz=t[2]
- c_cart=ela_voigt_to_cartesian(c_voigt)
+ c_cart=ela_voigt_to_cartesian(c_voigt, form)
  rot_c=rotate_ela(c_cart,[tx,ty,tz])
- rot_c_voigt=ela_cartesian_to_voigt(rot_c)
- rot_vector=vectorize_ela_voigt(rot_c_voigt)
+ rot_c_voigt=ela_cartesian_to_voigt(rot_c, form)
+ rot_vector=vectorize_ela_voigt(rot_c_voigt, form)
  proj_rot_vector=project_ela(rot_vector, sym = sym, verbose = verbose)
  res=rot_vector-proj_rot_vector
  result=np.dot(res,res)
@@ -1523,14 +2722,28 @@ def res_ela(t, c_voigt, sym = None, verbose = False):
 # with and without rotation optimization. Setting verbose = True will print
 # the info from the minimization routine. The list of symmetries to check is
 # complete by default. The user can override this if they're only interested
-# in a reduced set. This function requires Scipy.
+# in a reduced set. The tensor can be given in stiffness (form = "C", distances
+# in GPa) or compliance (form = "S", distances in 1/GPa) form, the projection
+# being carried out in the corresponding space. With method = "poly" the rotation
+# optimization starts from the global minimum on a grid of angles (see
+# ResidualPolynomial) instead of from zero angles. With method = "de" a global
+# search by differential evolution with the given population size and tolerance
+# is done (see de_minimize). With dtype (e.g., np.float32) the projections and
+# distances are computed in that precision; the rotation search itself is always
+# done in double precision. This function requires Scipy.
 def ela_dist(c_voigt,
              symlist = ["iso", "cub", "hex", "3", "32", "4", "4mm", "ort", "mon"],
-             rotate = False, xtol = 1e-8, verbose = True, printmin = False, normalize=False):
+             rotate = False, xtol = 1e-8, verbose = True, printmin = False, normalize=False,
+             form = "C", bounds = False, method = "fmin", popsize = 30, tolerance = 1e-6,
+             dtype = None):
  from scipy.optimize import fmin
  disp = 0
  if printmin:
   disp = 1
+ if form == "S":
+  printdist = "%9.2e 1/GPa"
+ else:
+  printdist = "%7.2f GPa"
  result = []
  if not rotate:
   if verbose:
@@ -1541,15 +2754,15 @@ def ela_dist(c_voigt,
    print("Symmetry     Euclidean distance                                    ")
    print("--------     ------------------                                    ")
   for sym in symlist:
-   v = vectorize_ela_voigt(c_voigt)
-   vp = project_ela(v, sym)
+   v = np.asarray(vectorize_ela_voigt(c_voigt, form), dtype=dtype)
+   vp = project_ela(v, sym, dtype=dtype)
    if normalize:
     edist2 = np.dot(v-vp,v-vp) / np.dot(v,v)
    else:
     edist2 = np.dot(v-vp,v-vp)
    edist = np.sqrt(edist2)
    if verbose:
-    print("%8s            %7.2f GPa" % (sym, edist))
+    print(("%8s            " + printdist) % (sym, edist))
    result.append([sym, edist])
   if verbose:
    print("************************** R E S U L T S **************************")
@@ -1562,15 +2775,21 @@ def ela_dist(c_voigt,
    print("                                                                   ")
    print("Symmetry     Euclidean distance     Angles tx,     ty,     tz      ")
    print("--------     ------------------     -------------------------------")
+  memo = RotationMemo(vectorize_ela_voigt(c_voigt, form), "elastic")
   for sym in symlist:
    topt = [0., 0., 0.]
    if sym != "iso":
-    topt = fmin(res_ela, x0=[0,0,0], xtol=xtol, args=(c_voigt, sym, verbose), disp=disp)
-   ct = ela_voigt_to_cartesian(c_voigt)
-   rotct = rotate_ela(ct, topt)
-   rot_voigt = ela_cartesian_to_voigt(rotct)
-   v = vectorize_ela_voigt(rot_voigt)
-   vp = project_ela(v, sym = sym, verbose=False)
+    if method == "poly":
+     topt = ResidualPolynomial(memo.vector, sym, "elastic", verbose).minimize(xtol, disp=disp)
+    elif method == "de":
+     topt = de_minimize(memo.vector, sym, "elastic", popsize, tolerance, xtol, verbose=verbose,
+                        disp=disp)
+    else:
+     topt = fmin(res_ela, x0=[0,0,0], xtol=xtol, args=(c_voigt, sym, verbose, form, memo), disp=disp)
+   v = memo.rotate(topt)
+   vp = memo.project(v, sym, verbose=False)
+   if dtype is not None:
+    v = np.asarray(v, dtype=dtype) ; vp = project_batch(v, sym, "elastic", False, dtype)
    if normalize:
     edist2 = np.dot(v-vp,v-vp) / np.dot(v,v)
    else:
@@ -1585,15 +2804,1950 @@ def ela_dist(c_voigt,
       or sym == "32" or sym == "3m" or sym == "-3m":
     printangles = ["%7.2f" % topt[0], "%7.2f" % topt[1], "    n/a"]
    if verbose:
-    print("%8s            %7.2f GPa       %s %s %s  deg." \
+    print(("%8s            " + printdist + "       %s %s %s  deg.") \
           % (sym, edist, printangles[0], printangles[1], printangles[2]))
    result.append([sym, edist, topt[0], topt[1], topt[2]])
   if verbose:
    print("************************** R E S U L T S **************************")
    print("                                                                   ")
+# Lower bounds from the harmonic decomposition (no optimization needed)
+ if bounds:
+  lower = harmonic_bounds(vectorize_ela_voigt(c_voigt, form), "elastic", symlist, normalize)
+  for i in range(0,len(result)):
+   result[i].append(lower[i][1])
+  print_harmonic_bounds(lower, printdist, verbose)
+ return result
+##################################################################################
+# Turns elastic tensor(s) in Kelvin (Mandel) notation, (...,6,6), into vector
+# form, (...,21), and back. The ordering is the same as in vectorize_ela_voigt
+def ela_mandel_to_vector(c_mandel):
+ i, j = np.triu_indices(6)
+ coeff = np.where(i == j, 1., np.sqrt(2.))
+ return np.array(c_mandel, dtype=float)[..., i, j] * coeff
+def ela_vector_to_mandel(vector_c_voigt):
+ i, j = np.triu_indices(6)
+ coeff = np.where(i == j, 1., np.sqrt(2.))
+ vectors = np.array(vector_c_voigt, dtype=float) / coeff
+ c_mandel = np.zeros(vectors.shape[:-1] + (6,6))
+ c_mandel[..., i, j] = vectors
+ c_mandel[..., j, i] = vectors
+ return c_mandel
+##################################################################################
+# Batched versions of vectorize_ela_voigt and tensorize_ela_voigt, for a single
+# 6x6 tensor or stacks (...,6,6) of them (vectors with shape (...,21))
+def vectorize_ela_voigt_batch(c_voigt, form = "C"):
+ c_voigt = np.array(c_voigt, dtype=float)
+ c_voigt = (c_voigt + np.swapaxes(c_voigt, -1, -2)) / 2.
+ return ela_mandel_to_vector(ela_voigt_to_mandel(c_voigt, form))
+def tensorize_ela_voigt_batch(vector_c_voigt, form = "C"):
+ return ela_mandel_to_voigt(ela_vector_to_mandel(vector_c_voigt), form)
+##################################################################################
+# Transforms elastic tensor(s) in Voigt notation to Cartesian notation. Works
+# with a single 6x6 matrix or with stacks of them, shape (...,6,6), returning an
+# array with shape (...,3,3,3,3)
+def ela_voigt_to_cartesian_batch(c_voigt, form = "C"):
+ index = np.array([[0, 5, 4], [5, 1, 3], [4, 3, 2]])
+ c_voigt = np.array(c_voigt, dtype=float)
+ c_cart = c_voigt[..., index[:, :, None, None], index[None, None, :, :]]
+ if form == "S":
+  coeff = np.where(index >= 3, 0.5, 1.)
+  c_cart = c_cart * coeff[:, :, None, None] * coeff[None, None, :, :]
+ return c_cart
+##################################################################################
+# Computes directional elastic properties for an (M,3) array of directions n:
+# Young's modulus E(n), linear compressibility beta(n), and shear modulus G(n,m)
+# and Poisson ratio nu(n,m), where the latter two depend also on a second
+# direction m perpendicular to n and are sampled over nperp such directions
+# (minimum, maximum and average over m are returned). The tensor(s) are given in
+# Voigt notation, a single one (6x6) or a stack (N,6,6), in stiffness or
+# compliance form. All the quantities are obtained from the compliance tensor in
+# one vectorized pass. Returns a dictionary of arrays of shape (M) or (N,M).
+# Units are those of the input, e.g., GPa and 1/GPa
+def ela_directional(c_voigt, directions, form = "C", nperp = 36):
+ if form == "S":
+  s_voigt = np.array(c_voigt, dtype=float)
+ else:
+  s_voigt = invert_ela_voigt(c_voigt, form)
+ s_cart = ela_voigt_to_cartesian_batch(s_voigt, "S")
+ n = np.array(directions, dtype=float).reshape(-1,3)
+ n = n / np.linalg.norm(n, axis=1)[:, None]
+ m = perpendicular_directions(n, nperp)
+# Contractions with n that are needed for all the properties
+ snn = np.einsum("...ijkl,ai,aj->...akl", s_cart, n, n, optimize=True)
+ sn_n = np.einsum("...ijkl,ai,ak->...ajl", s_cart, n, n, optimize=True)
+ young = 1. / np.einsum("...akl,ak,al->...a", snn, n, n)
+ compressibility = np.einsum("...akk->...a", snn)
+ shear = 1. / (4. * np.einsum("...ajl,abj,abl->...ab", sn_n, m, m))
+ poisson = -young[..., None] * np.einsum("...akl,abk,abl->...ab", snn, m, m)
+ result = {"young": young, "compressibility": compressibility,
+           "shear_min": shear.min(axis=-1), "shear_max": shear.max(axis=-1),
+           "shear_avg": shear.mean(axis=-1),
+           "poisson_min": poisson.min(axis=-1), "poisson_max": poisson.max(axis=-1),
+           "poisson_avg": poisson.mean(axis=-1)}
+ return result
+##################################################################################
+# Computes the Voigt, Reuss and Hill aggregate (polycrystalline) bulk and shear
+# moduli, together with the corresponding Young's moduli and Poisson ratios, for
+# a single tensor (6x6) or a stack of tensors (N,6,6) in Voigt notation. Returns
+# a dictionary with keys "K_V", "G_V", "E_V", "nu_V" and the same for "R" and "H"
+def ela_aggregates(c_voigt, form = "C"):
+ if form == "S":
+  s = np.array(c_voigt, dtype=float)
+  c = invert_ela_voigt(s, "S")
+ else:
+  c = np.array(c_voigt, dtype=float)
+  s = invert_ela_voigt(c, "C")
+ a = c[..., 0, 0] + c[..., 1, 1] + c[..., 2, 2]
+ b = c[..., 0, 1] + c[..., 0, 2] + c[..., 1, 2]
+ d = c[..., 3, 3] + c[..., 4, 4] + c[..., 5, 5]
+ kv = (a + 2.*b) / 9.
+ gv = (a - b + 3.*d) / 15.
+ a = s[..., 0, 0] + s[..., 1, 1] + s[..., 2, 2]
+ b = s[..., 0, 1] + s[..., 0, 2] + s[..., 1, 2]
+ d = s[..., 3, 3] + s[..., 4, 4] + s[..., 5, 5]
+ kr = 1. / (a + 2.*b)
+ gr = 15. / (4.*a - 4.*b + 3.*d)
+ result = {"K_V": kv, "G_V": gv, "K_R": kr, "G_R": gr,
+           "K_H": (kv + kr) / 2., "G_H": (gv + gr) / 2.}
+ for label in ["V", "R", "H"]:
+  k = result["K_" + label] ; g = result["G_" + label]
+  result["E_" + label] = 9.*k*g / (3.*k + g)
+  result["nu_" + label] = (3.*k - 2.*g) / (2.*(3.*k + g))
+ return result
+##################################################################################
+# Transforms elastic tensor(s) in Cartesian notation to Voigt notation. Works
+# with a single 3x3x3x3 tensor or with stacks of them, shape (...,3,3,3,3)
+def ela_cartesian_to_voigt_batch(c_cart, form = "C"):
+ i = np.array([0, 1, 2, 1, 0, 0])
+ j = np.array([0, 1, 2, 2, 2, 1])
+ c_cart = np.array(c_cart, dtype=float)
+ c_voigt = c_cart[..., i[:, None], j[:, None], i[None, :], j[None, :]]
+ if form == "S":
+  coeff = np.array([1., 1., 1., 2., 2., 2.])
+  c_voigt = c_voigt * np.outer(coeff, coeff)
+ return c_voigt
+##################################################################################
+# Solves the Christoffel equation for an (M,3) array of propagation directions n,
+# giving the phase velocities and polarizations of the three acoustic modes. The
+# elastic tensor(s) can be given in Voigt notation, (...,6,6), or Cartesian
+# notation, (...,3,3,3,3), and density in kg/m^3. The elastic constants are
+# assumed to be in GPa, this can be changed with punit (factor to convert them to
+# Pa). The (...,M,3,3) Christoffel matrices Gamma_ik = C_ijkl n_j n_l are built
+# with einsum and diagonalized in one call. If the piezoelectric tensor (e form,
+# Cartesian notation, C/m^2) and the permittivity (3x3, F/m) are given, the
+# piezoelectrically stiffened Christoffel matrices are used:
+#   Gamma_ik += (e_pij n_p n_j) (e_qkl n_q n_l) / (eps_pq n_p n_q)
+# Velocities (m/s) are returned with shape (...,M,3) in increasing order and the
+# polarizations with shape (...,M,3,3), where [...,a,k,:] is the unit
+# displacement vector of mode k for direction a
+def christoffel(c_tensor, directions, density, form = "C", e_cart = None,
+                permittivity = None, punit = 1e9):
+ c_tensor = np.array(c_tensor, dtype=float)
+ if c_tensor.shape[-2:] == (6,6):
+  if form == "S":
+   c_tensor = invert_ela_voigt(c_tensor, "S")
+  c_cart = ela_voigt_to_cartesian_batch(c_tensor)
+ else:
+  c_cart = c_tensor
+  if form == "S":
+   c_cart = ela_voigt_to_cartesian_batch(invert_ela_voigt(ela_cartesian_to_voigt_batch(c_tensor, "S"), "S"))
+ n = np.array(directions, dtype=float).reshape(-1,3)
+ n = n / np.linalg.norm(n, axis=1)[:, None]
+ gamma = np.einsum("...ijkl,aj,al->...aik", c_cart, n, n, optimize=True)
+ if e_cart is not None and permittivity is not None:
+  e_cart = np.array(e_cart, dtype=float)
+  eps = np.einsum("...pq,ap,aq->...a", np.array(permittivity, dtype=float), n, n)
+  g = np.einsum("...pij,ap,aj->...ai", e_cart, n, n, optimize=True)
+  gamma = gamma + g[..., :, None] * g[..., None, :] / eps[..., None, None] / punit
+ w, v = np.linalg.eigh(gamma)
+ velocities = np.sqrt(np.clip(w, 0., None) * punit / density)
+ polarizations = np.swapaxes(v, -1, -2)
+ return velocities, polarizations
+##################################################################################
+# Born stability criteria, in the form of Mouhat and Coudert [Phys. Rev. B 90,
+# 224104 (2014)], for a stack of stiffness tensors (N,6,6) in Voigt notation with
+# the given symmetry (the tensors are assumed to have that symmetry in the
+# standard orientation, e.g., projected onto it). Returns a dictionary with the
+# name of each criterion and a boolean array telling which tensors satisfy it.
+# For orthorhombic and lower symmetries (and sym = None) the only criterion is
+# the positive definiteness of the Kelvin (Mandel) matrix
+def born_criteria(c_voigt, sym = None, tol = 0.):
+ c = np.array(c_voigt, dtype=float).reshape(-1,6,6)
+ C11 = c[:,0,0] ; C12 = c[:,0,1] ; C13 = c[:,0,2] ; C14 = c[:,0,3] ; C15 = c[:,0,4]
+ C16 = c[:,0,5] ; C33 = c[:,2,2] ; C44 = c[:,3,3] ; C66 = c[:,5,5]
+ criteria = {}
+ if sym in ["iso", "cub", "23", "m-3", "432", "-43m", "m-3m"]:
+  criteria["C11 - C12 > 0"] = C11 - C12 > tol
+  criteria["C11 + 2 C12 > 0"] = C11 + 2.*C12 > tol
+  criteria["C44 > 0"] = C44 > tol
+ elif sym in ["hex", "6", "-6", "6/m", "622", "6mm", "-62m", "6/mmm",
+              "tet", "4", "-4", "4/m", "422", "4mm", "-42m", "4/mmm"]:
+  criteria["C11 > |C12|"] = C11 - np.abs(C12) > tol
+  criteria["2 C13^2 < C33 (C11 + C12)"] = C33*(C11 + C12) - 2.*C13**2 > tol
+  criteria["C44 > 0"] = C44 > tol
+  criteria["C66 > 0"] = C66 > tol
+  if sym in ["tet", "4", "-4", "4/m"]:
+   criteria["2 C16^2 < C66 (C11 - C12)"] = C66*(C11 - C12) - 2.*C16**2 > tol
+ elif sym in ["tig", "3", "-3", "32", "3m", "-3m"]:
+  criteria["C11 > |C12|"] = C11 - np.abs(C12) > tol
+  criteria["C44 > 0"] = C44 > tol
+  criteria["C13^2 < C33 (C11 + C12) / 2"] = C33*(C11 + C12)/2. - C13**2 > tol
+  criteria["C14^2 + C15^2 < C44 (C11 - C12) / 2"] = C44*(C11 - C12)/2. - C14**2 - C15**2 > tol
+ else:
+  mandel = ela_voigt_to_mandel(c, "C")
+  criteria["positive definite"] = np.linalg.eigvalsh(mandel)[:,0] > tol
+ return criteria
+##################################################################################
+# Mechanical (Born) stability of a stack of elastic tensors (anything accepted by
+# get_vector_stack, in stiffness or compliance form). The minimum eigenvalues of
+# all the Kelvin (Mandel) matrices are obtained in one np.linalg.eigvalsh call (a
+# tensor is stable if they are positive, the same condition holding for C and S).
+# If a symmetry is given, the tensors are also projected onto it and the specific
+# Born criteria of that symmetry are evaluated for the projections (see
+# born_criteria). Returns a dictionary with the "min_eigenvalue" and "stable"
+# arrays and, for a given symmetry, the "criteria" dictionary and "stable_sym"
+def born_stability(tensors, form = None, sym = None, tol = 0., verbose = True):
+ shape0, form, vectors = get_vector_stack(tensors, form)
+ if shape0 != "elastic":
+  print_check_shape_error(verbose)
+  return None
+ eigenvalues = np.linalg.eigvalsh(ela_vector_to_mandel(vectors))
+ result = {"min_eigenvalue": eigenvalues[:,0], "stable": eigenvalues[:,0] > tol}
+ if sym:
+  voigt = tensorize_ela_voigt_batch(project_batch(vectors, sym, shape0, verbose), form)
+  if form == "S":
+   voigt = invert_ela_voigt(voigt, "S")
+  criteria = born_criteria(voigt, sym, tol)
+  result["criteria"] = criteria
+  result["stable_sym"] = np.all([criteria[key] for key in criteria], axis=0)
  return result
 ##################################################################################
 ##################################################################################
 ############### End of functions for stiffness tensor manipulation ###############
 ##################################################################################
 ##################################################################################
+
+
+
+
+
+##################################################################################
+##################################################################################
+##### Rotation invariants and similarity search over databases of tensors    #####
+##################################################################################
+##################################################################################
+# Returns the orthogonal projectors (acting on the vector form) onto the
+# harmonic (irreducible SO(3)) components of elastic or piezoelectric tensors.
+# The elastic tensor splits into two scalars, two deviators and a fourth-order
+# harmonic tensor, C = 0s + 0a + 2s + 2a + 4, where "s" components belong to the
+# totally symmetric part of the tensor and "a" components to the remainder. The
+# piezoelectric tensor splits into two vectors, a deviator and a third-order
+# harmonic tensor, e = 1s + 1a + 2 + 3. The projectors are built numerically from
+# the total symmetrization and the trace maps, and are returned in a dictionary
+def get_harmonic_projectors(shape0):
+ if shape0 == "elastic":
+  n = 21
+  to_cart = lambda v: ela_voigt_to_cartesian_batch(tensorize_ela_voigt_batch(v))
+  to_vector = lambda c: vectorize_ela_voigt_batch(ela_cartesian_to_voigt_batch(c))
+  symmetrize = lambda c: (c + np.einsum("...acbd->...abcd", c) + np.einsum("...adbc->...abcd", c)) / 3.
+  trace_sym = lambda c: np.einsum("...ijkk->...ij", c).reshape(c.shape[:-4] + (9,))
+  trace_asym = trace_sym
+ elif shape0 == "piezoelectric":
+  n = 18
+  to_cart = lambda v: np.einsum("...iJ,Jjk->...ijk", v.reshape(v.shape[:-1] + (3,6)), get_mandel_basis())
+  to_vector = lambda c: np.einsum("...ijk,Jjk->...iJ", c, get_mandel_basis()).reshape(c.shape[:-3] + (18,))
+  symmetrize = lambda c: (c + np.einsum("...bac->...abc", c) + np.einsum("...cab->...abc", c)) / 3.
+  trace_sym = lambda c: np.einsum("...ikk->...i", c)
+  trace_asym = trace_sym
+ else:
+  print("Not implemented!")
+  return None
+ identity = np.eye(n)
+ psym = to_vector(symmetrize(to_cart(identity))).T
+ psym = (psym + psym.T) / 2.
+# Splits the range of a projector into the row space and the kernel of a map
+ def split(projector, tmap):
+  w, v = np.linalg.eigh(projector)
+  basis = v[:, w > 0.5]
+  image = tmap(to_cart(basis.T))
+  u, sv, vt = np.linalg.svd(image.T)
+  rank = np.sum(sv > 1e-10 * sv.max())
+  row = np.dot(basis, vt[0:rank].T)
+  kernel = np.dot(basis, vt[rank:].T)
+  return np.dot(row, row.T), np.dot(kernel, kernel.T)
+ psym_trace, psym_free = split(psym, trace_sym)
+ pasym_trace, pasym_free = split(identity - psym, trace_asym)
+ if shape0 == "elastic":
+# Within the trace (second-rank) components, the scalars are the isotropic parts
+  iso = get_ela_projector("iso", False)
+  p0s = np.dot(np.dot(psym_trace, iso), psym_trace)
+  p0a = np.dot(np.dot(pasym_trace, iso), pasym_trace)
+  return {"0s": p0s, "0a": p0a, "2s": psym_trace - p0s, "2a": pasym_trace - p0a,
+          "4": psym_free}
+ if shape0 == "piezoelectric":
+  return {"1s": psym_trace, "1a": pasym_trace, "2": pasym_free, "3": psym_free}
+##################################################################################
+# Harmonic decomposition of a stack of tensors in vector form, shape (...,n).
+# Returns a dictionary with the harmonic components (see get_harmonic_projectors)
+# in vector form, which add up to the original tensors
+def harmonic_decomposition(vectors, shape0):
+ vectors = np.array(vectors, dtype=float)
+ projectors = get_harmonic_projectors(shape0)
+ parts = {}
+ for key in projectors:
+  parts[key] = np.dot(vectors, projectors[key].T)
+ return parts
+##################################################################################
+# Reconstructs the tensors from their harmonic components (any representation
+# for which the components can be added up, e.g., vector or Voigt form)
+def harmonic_reconstruction(parts):
+ result = None
+ for key in parts:
+  part = np.array(parts[key], dtype=float)
+  if result is None:
+   result = part.copy()
+  else:
+   result += part
+ return result
+##################################################################################
+# Rotation-invariant norms of the harmonic components of a stack of tensors in
+# vector form. Returns a dictionary of arrays with shape (...)
+def harmonic_norms(vectors, shape0):
+ parts = harmonic_decomposition(vectors, shape0)
+ norms = {}
+ for key in parts:
+  norms[key] = np.linalg.norm(parts[key], axis=-1)
+ return norms
+##################################################################################
+# Lower bounds for the rotated Euclidean distance to each symmetry in symlist,
+# obtained from the harmonic decomposition without any optimization. Since the
+# projectors commute with the harmonic decomposition, the squared distance is the
+# sum of the distances of each harmonic component to the subspace allowed by the
+# symmetry, and each of them is bounded from below by rotation invariants:
+#  - Elastic: the distance to isotropy is exact; cubic tensors have no deviators;
+#    the deviators of tensors with a 3-, 4- or 6-fold axis are uniaxial, and the
+#    distance of a deviator to the closest uniaxial one follows from its
+#    eigenvalues.
+#  - Piezoelectric: the distance is exact for isotropy, point group 432 and the
+#    centrosymmetric groups (zero projection); non-polar groups have no vector
+#    components; in polar groups with a single axis both vectors are parallel to
+#    it; the deviator vanishes for cubic groups.
+# Returns a list of [sym, lower_bound], for a single tensor in vector form, or
+# for a stack of them (lower_bound is then an array)
+def harmonic_bounds(vectors, shape0, symlist, normalize = False):
+ vectors = np.array(vectors, dtype=float)
+ parts = harmonic_decomposition(vectors, shape0)
+ norm2 = {}
+ for key in parts:
+  norm2[key] = np.sum(parts[key]**2, axis=-1)
+ total2 = np.sum(vectors**2, axis=-1)
+ axial = ["hex", "6", "-6", "6/m", "622", "6mm", "-62m", "6/mmm", "tig", "3", "-3",
+          "32", "3m", "-3m", "tet", "4", "-4", "4/m", "422", "4mm", "-42m", "4/mmm"]
+ cubic = ["cub", "23", "m-3", "432", "-43m", "m-3m"]
+ if shape0 == "elastic":
+# Relative distance (squared) of each deviator to the closest uniaxial deviator
+  uniaxial = 0.
+  for key in ["2s", "2a"]:
+   w = np.linalg.eigvalsh(get_frame_tensor(parts[key], shape0))
+   gap = np.minimum((w[..., 1] - w[..., 0])**2, (w[..., 2] - w[..., 1])**2) / 2.
+   uniaxial = uniaxial + norm2[key] * gap / np.maximum(np.sum(w**2, axis=-1), 1e-300)
+ if shape0 == "piezoelectric":
+# Vector components as 3-vectors scaled to the norm of the component
+  m = 0.
+  for key in ["1s", "1a"]:
+   v = np.einsum("...ikk->...i", np.einsum("...iJ,Jjk->...ijk",
+                 parts[key].reshape(parts[key].shape[:-1] + (3,6)), get_mandel_basis()))
+   v = v * np.sqrt(norm2[key] / np.maximum(np.sum(v**2, axis=-1), 1e-300))[..., None]
+   m = m + v[..., :, None] * v[..., None, :]
+  w = np.linalg.eigvalsh(m)
+  cspointgroups = ["m-3", "m-3m", "6/m", "6/mmm", "-3", "-3m", "4/m", "4/mmm", "2/m", "mmm", "-1"]
+  polar = ["6", "4", "3", "6mm", "4mm", "3m", "2", "mm2"]
+ result = []
+ for sym in symlist:
+  bound2 = 0. * total2
+  if shape0 == "elastic":
+   if sym == "iso":
+    bound2 = total2 - norm2["0s"] - norm2["0a"]
+   elif sym in cubic:
+    bound2 = norm2["2s"] + norm2["2a"]
+   elif sym in axial:
+    bound2 = uniaxial
+  if shape0 == "piezoelectric":
+# Crystal classes stand for the default point group of get_pz_projector
+   pg = pz_defaultpg.get(sym, sym)
+   if pg == "iso" or pg == "432" or pg in cspointgroups:
+    bound2 = total2
+   elif pg in polar:
+    bound2 = w[..., 0] + w[..., 1]
+   elif pg not in ["m", "1", "-2"]:
+    bound2 = norm2["1s"] + norm2["1a"]
+   if pg in ["23", "-43m"]:
+    bound2 = bound2 + norm2["2"]
+  if normalize:
+   bound2 = bound2 / total2
+  result.append([sym, np.sqrt(np.maximum(bound2, 0.))])
+ return result
+##################################################################################
+# Computes rotation-invariant fingerprints for a stack of tensors in vector form
+# (N,n). For elastic tensors these are the eigenvalues of the Kelvin matrix and
+# the eigenvalues of the dilatational (C_ijkk) and Voigt (C_ikjk) second-rank
+# tensors (12 numbers). For piezoelectric tensors these are the singular values of
+# the 3x6 Kelvin matrix, the eigenvalues of the second-rank tensor e_ijl e_ikl and
+# the norms of the vectors e_ikk and e_kki (8 numbers). The first 6 (elastic) or
+# 3 (piezoelectric) numbers are such that the Euclidean distance between them is
+# a lower bound for the rotated distance between the tensors (Hoffman-Wielandt
+# and Mirsky inequalities). With normalize = True the
+# tensors are scaled to unit norm first, so that the fingerprints do not depend
+# on the overall magnitude of the tensor
+def get_invariants(vectors, shape0, normalize = False):
+ vectors = np.array(vectors, dtype=float)
+ if normalize:
+  vectors = vectors / np.linalg.norm(vectors, axis=-1)[..., None]
+ if shape0 == "elastic":
+  mandel = ela_vector_to_mandel(vectors)
+  c_cart = ela_voigt_to_cartesian_batch(ela_mandel_to_voigt(mandel))
+  kelvin = np.linalg.eigvalsh(mandel)
+  dilatational = np.linalg.eigvalsh(np.einsum("...ijkk->...ij", c_cart))
+  voigt = np.linalg.eigvalsh(np.einsum("...ikjk->...ij", c_cart))
+  return np.concatenate([kelvin, dilatational, voigt], axis=-1)
+ if shape0 == "piezoelectric":
+  mandel = vectors.reshape(vectors.shape[:-1] + (3,6))
+  e_cart = np.einsum("...iJ,Jjk->...ijk", mandel, get_mandel_basis())
+  singular = np.linalg.svd(mandel, compute_uv=False)
+  second = np.linalg.eigvalsh(np.einsum("...ijl,...ikl->...jk", e_cart, e_cart))
+  v1 = np.linalg.norm(np.einsum("...ikk->...i", e_cart), axis=-1)
+  v2 = np.linalg.norm(np.einsum("...kki->...i", e_cart), axis=-1)
+  return np.concatenate([singular, second, v1[..., None], v2[..., None]], axis=-1)
+ print("Not implemented!")
+##################################################################################
+# Builds, for a stack of tensors in vector form, a symmetric second-rank tensor
+# that rotates as R.A.R^T together with the original tensor, so that its
+# eigenvectors define a frame attached to it: the dilatational tensor C_ijkk for
+# elastic tensors, e_kil e_kjl for piezoelectric tensors and M + M^T for lattice
+# matrices. Shape (...,3,3)
+def get_frame_tensor(vectors, shape0):
+ vectors = np.array(vectors, dtype=float)
+ if shape0 == "elastic":
+  c_cart = ela_voigt_to_cartesian_batch(tensorize_ela_voigt_batch(vectors))
+  return np.einsum("...ijkk->...ij", c_cart)
+ if shape0 == "piezoelectric":
+  mandel = vectors.reshape(vectors.shape[:-1] + (3,6))
+  e_cart = np.einsum("...iJ,Jjk->...ijk", mandel, get_mandel_basis())
+  return np.einsum("...kil,...kjl->...ij", e_cart, e_cart)
+ if shape0 == "lattice":
+  cart = vectors.reshape(vectors.shape[:-1] + (3,3))
+  return cart + np.swapaxes(cart, -1, -2)
+##################################################################################
+# Returns the (4,3,3) proper rotations that map the eigenframe of the frame
+# tensor of vector onto the eigenframe of the frame tensor of reference (one for
+# each choice of the signs of the eigenvectors)
+def get_frame_rotations(vector, reference, shape0):
+ w, vq = np.linalg.eigh(get_frame_tensor(vector, shape0))
+ w, vr = np.linalg.eigh(get_frame_tensor(reference, shape0))
+ signs = np.array([[1., 1., 1.], [-1., -1., 1.], [-1., 1., -1.], [1., -1., -1.]])
+ if np.linalg.det(vq) * np.linalg.det(vr) < 0.:
+  signs = -signs
+ return np.einsum("ij,sj,kj->sik", vr, signs, vq)
+##################################################################################
+##################################################################################
+# Evaluates the "longitudinal" form of a tensor in vector form along an (M,3)
+# array of unit directions n: C_ijkl n_i n_j n_k n_l (elastic), e_ijk n_i n_j n_k
+# (piezoelectric) or n_i M_ij n_j (lattice)
+def longitudinal_form(vector, shape0, directions):
+ n = np.array(directions, dtype=float).reshape(-1,3)
+ if shape0 == "elastic":
+  c_cart = ela_voigt_to_cartesian_batch(tensorize_ela_voigt_batch(vector))
+  return np.einsum("ijkl,ai,aj,ak,al->a", c_cart, n, n, n, n, optimize=True)
+ if shape0 == "piezoelectric":
+  e_cart = np.einsum("iJ,Jjk->ijk", np.reshape(vector, (3,6)), get_mandel_basis())
+  return np.einsum("ijk,ai,aj,ak->a", e_cart, n, n, n, optimize=True)
+ if shape0 == "lattice":
+  return np.einsum("ij,ai,aj->a", np.reshape(vector, (3,3)), n, n)
+##################################################################################
+# Direction of the maximum of the longitudinal form, searched on a sphere mesh and
+# refined locally (requires Scipy). If axis is given, the search is restricted to
+# the cone of directions at 60 degrees from it (where the in-plane anisotropy of
+# tensors with a 3-fold axis, for which the longitudinal form is isotropic in the
+# perpendicular plane, shows up) and the direction perpendicular to the axis with
+# the same azimuth is returned
+def get_longitudinal_maximum(vector, shape0, axis = None, npoints = 2000):
+ from scipy.optimize import fmin
+ if axis is None:
+  mesh = sphere_mesh(npoints)
+  n0 = mesh[np.argmax(longitudinal_form(vector, shape0, mesh))]
+  point = lambda t: np.array([np.sin(t[0])*np.cos(t[1]), np.sin(t[0])*np.sin(t[1]), np.cos(t[0])])
+  t0 = [np.arccos(np.clip(n0[2], -1., 1.)), np.arctan2(n0[1], n0[0])]
+  topt = fmin(lambda t: -longitudinal_form(vector, shape0, point(t))[0], x0=t0, xtol=1e-10, ftol=1e-14, disp=0)
+  return point(topt)
+ u = perpendicular_directions(axis, 1)[0][0]
+ w = np.cross(axis, u)
+ plane = lambda t: np.outer(np.cos(t), u) + np.outer(np.sin(t), w)
+ cone = lambda t: np.cos(np.pi/3.)*np.array(axis) + np.sin(np.pi/3.)*plane(t)
+ grid = 2. * np.pi * np.arange(0, npoints) / npoints
+ t0 = [grid[np.argmax(longitudinal_form(vector, shape0, cone(grid)))]]
+ topt = fmin(lambda t: -longitudinal_form(vector, shape0, cone(t))[0], x0=t0, xtol=1e-10, ftol=1e-14, disp=0)
+ return plane(topt)[0]
+##################################################################################
+# Finds the rotation matrix that brings a tensor (vector form) into a standard
+# orientation. The axes are the eigenvectors of the frame tensor (see
+# get_frame_tensor), in decreasing order of the eigenvalues. When two eigenvalues
+# are degenerate (relative tolerance tol) the non-degenerate eigenvector is taken
+# as the z axis and the x axis is the direction perpendicular to it where the
+# longitudinal form is maximum; when all three are degenerate the z axis is also
+# taken at the maximum of the longitudinal form. The remaining sign ambiguities
+# are resolved by choosing, among the possible frames, the one giving the
+# lexicographically largest rotated vector (after rounding to quantum)
+def canonical_rotation(vector, shape0, tol = 1e-4, quantum = 1e-6):
+ vector = np.array(vector, dtype=float)
+ w, v = np.linalg.eigh(get_frame_tensor(vector, shape0))
+ w = w[::-1] ; v = v[:, ::-1]
+ scale = max(np.abs(w).max(), 1e-300)
+ gap = np.abs(np.diff(w)) / scale
+ frames = []
+ if gap.min() > tol:
+  for signs in [[1., 1.], [-1., 1.], [1., -1.], [-1., -1.]]:
+   x = signs[0] * v[:, 0] ; y = signs[1] * v[:, 1]
+   frames.append([x, y, np.cross(x, y)])
+ else:
+  if gap.max() <= tol:
+   z = get_longitudinal_maximum(vector, shape0)
+  elif gap[0] <= tol:
+   z = v[:, 2]
+  else:
+   z = v[:, 0]
+  for zs in [z, -z]:
+   x = get_longitudinal_maximum(vector, shape0, zs)
+   for xs in [x, -x]:
+    frames.append([xs, np.cross(zs, xs), zs])
+ frames = np.array(frames)
+ rotated = rotate_vector_batch(vector, frames, shape0)
+ keys = [tuple(np.rint(r / (quantum * max(np.linalg.norm(vector), 1e-300))).astype(int)) for r in rotated]
+ best = max(range(0,len(frames)), key = lambda i: keys[i])
+ return frames[best]
+##################################################################################
+# Rotates a stack of tensors in vector form (N,n) into their standard orientation
+# (see canonical_rotation). Returns the rotated vectors and the rotation angles
+# (N,3) that were applied, in the convention of the rotate_* functions
+def canonicalize_batch(vectors, shape0, tol = 1e-4):
+ vectors = np.array(vectors, dtype=float).reshape(len(vectors), -1)
+ rotations = np.array([canonical_rotation(v, shape0, tol) for v in vectors])
+ return rotate_vector_batch(vectors, rotations, shape0), rotation_angles(rotations)
+##################################################################################
+# Returns a hash (hexadecimal string) of the canonical form of each tensor, with
+# the components rounded to multiples of quantum (in the units of the tensor, or
+# relative to the tensor norm with normalize = True). Equal tensors in different
+# orientations get the same hash, so that the hashes can be used in sets, dicts
+# or as database keys to find duplicates in O(1). Tensors that differ by less
+# than quantum get the same hash except for those that fall on different sides
+# of a rounding boundary. The input is as in get_vector_stack; a list of hashes is
+# returned
+def tensor_hashes(tensors, quantum = 1e-2, normalize = False, tol = 1e-4, form = None):
+ import hashlib
+ shape0, form, vectors = get_vector_stack(tensors, form)
+ canonical, angles = canonicalize_batch(vectors, shape0, tol)
+ if normalize:
+  canonical = canonical / np.linalg.norm(canonical, axis=1)[:, None]
+ result = []
+ for v in canonical:
+  q = np.rint(v / quantum).astype(np.int64) + 0
+  key = ("%s:%s:" % (shape0, form)).encode() + q.tobytes()
+  result.append(hashlib.sha1(key).hexdigest())
+ return result
+##################################################################################
+# Creates the function to be minimized to find the rotation that brings a tensor
+# (vector form) closest to a reference one, in terms of the rotation angles
+def res_pair(t, vector, reference, shape0):
+ rot_vector = rotate_vector_batch(vector, rotation_matrix(t), shape0)
+ res = rot_vector - reference
+ return np.dot(res, res)
+##################################################################################
+# Euclidean distance between two tensors in vector form up to a rotation, i.e.,
+# the minimum over rotations R of |R(vector) - reference|. The rotation is first
+# searched among the rotations that align the eigenframes of the two tensors (see
+# get_frame_rotations) and on a coarse grid of ngrid^3 angles (evaluated in one
+# batched call), and then refined locally starting from the nstart best. Returns
+# [distance, tx, ty, tz], where the angles are those that rotate vector onto
+# reference. This function requires Scipy.
+def rotated_dist(vector, reference, shape0, xtol = 1e-8, ngrid = 8, nstart = 4, normalize = False):
+ from scipy.optimize import fmin
+ vector = np.array(vector, dtype=float)
+ reference = np.array(reference, dtype=float)
+ if normalize:
+  vector = vector / np.linalg.norm(vector)
+  reference = reference / np.linalg.norm(reference)
+ grid = np.arange(0, ngrid) * 180. / ngrid
+ grid = np.stack(np.meshgrid(2.*grid, grid - 90. + 90./ngrid, 2.*grid, indexing="ij"), axis=-1).reshape(-1,3)
+ grid = np.concatenate([rotation_angles(get_frame_rotations(vector, reference, shape0)), grid])
+ res = rotate_vector_batch(vector, rotation_matrix(grid), shape0) - reference
+ starts = grid[np.argsort(np.sum(res**2, axis=1))[0:nstart]]
+ best = None
+ for t0 in starts:
+  topt = fmin(res_pair, x0=t0, xtol=xtol, args=(vector, reference, shape0), disp=0)
+  edist2 = res_pair(topt, vector, reference, shape0)
+  if best is None or edist2 < best[0]:
+   best = [edist2, topt]
+ topt = best[1]
+ return [np.sqrt(best[0]), topt[0], topt[1], topt[2]]
+##################################################################################
+# Index for similarity searches over a database of tensors up to rotation. The
+# database is given as in get_vector_stack (list of Tensor objects or stack of
+# arrays) and the rotation-invariant fingerprints of all the tensors are stored
+# in a KD-tree. A query looks up the closest fingerprints (a cheap shortlist) and
+# then computes the exact rotated distance only for the shortlisted entries whose
+# invariant lower bound does not already exclude them. This class requires Scipy.
+class TensorIndex:
+# Initialization
+ def __init__(self, tensors, form = None, normalize = False):
+  from scipy.spatial import cKDTree
+  shape0, form, vectors = get_vector_stack(tensors, form)
+  self.shape0 = shape0
+  self.form = form
+  self.normalize = normalize
+  self.vectors = vectors
+  self.invariants = get_invariants(vectors, shape0, normalize)
+  self.tree = cKDTree(self.invariants)
+# Query method. Returns the k database entries closest to tensor as a list of
+# [index, distance, tx, ty, tz], sorted by distance, where the angles rotate the
+# query tensor onto the database entry. The shortlist of entries with closest
+# fingerprints is ranked first with a cheap step: upper bounds for the rotated
+# distance are obtained from the rotations that align the eigenframes of the
+# tensors and from a coarse grid of ngrid^3 angles, all the rotations of the query
+# being done in batched calls (a few milliseconds for the whole shortlist). With
+# refine = False these upper bounds are returned as the distances. Otherwise the
+# entries are refined with one local minimization each (typically tens of
+# milliseconds per entry), in order of increasing upper bound, skipping those
+# whose invariant lower bound is not below the k-th best distance found so far.
+# With rotate = False only the KD-tree lookup is done and the distance between
+# fingerprints is returned
+ def query(self, tensor, k = 1, shortlist = 10, rotate = True, xtol = 1e-8, refine = True,
+           ngrid = 6):
+  from scipy.optimize import fmin
+  shape0, form, vector = get_vector_stack(tensor, self.form)
+  if shape0 != self.shape0 or form != self.form:
+   print_check_shape_error(True)
+   return None
+  invariants = get_invariants(vector, shape0, self.normalize)[0]
+  nquery = min(max(k, shortlist), len(self.vectors))
+  if not rotate:
+   nquery = min(k, len(self.vectors))
+  fdist, index = self.tree.query(invariants, k=nquery)
+  fdist = np.atleast_1d(fdist) ; index = np.atleast_1d(index)
+  if not rotate:
+   return [[int(index[i]), fdist[i]] for i in range(0,nquery)]
+  nbound = {"elastic": 6, "piezoelectric": 3}[shape0]
+  bound = np.linalg.norm(self.invariants[index][:, 0:nbound] - invariants[0:nbound], axis=1)
+  query = np.array(vector[0], dtype=float)
+  references = np.array(self.vectors[index], dtype=float)
+  if self.normalize:
+   query = query / np.linalg.norm(query)
+   references = references / np.linalg.norm(references, axis=1)[:, None]
+# Cheap ranking step: eigenframe alignments (4 per entry) and a shared grid
+  grid = np.arange(0, ngrid) * 180. / ngrid
+  grid = np.stack(np.meshgrid(2.*grid, grid - 90. + 90./ngrid, 2.*grid, indexing="ij"),
+                  axis=-1).reshape(-1,3)
+  frames = np.array([rotation_angles(get_frame_rotations(query, reference, shape0))
+                     for reference in references])
+  angles = np.concatenate([frames, np.broadcast_to(grid, (len(index),) + grid.shape)], axis=1)
+  rotated = rotate_vector_batch(query, rotation_matrix(angles), shape0)
+  res2 = np.sum((rotated - references[:, None, :])**2, axis=-1)
+  best = np.argmin(res2, axis=1)
+  upper = np.sqrt(res2[np.arange(0,len(index)), best])
+  starts = angles[np.arange(0,len(index)), best]
+  order = np.argsort(upper, kind="stable")
+  if not refine:
+   return [[int(index[i]), upper[i]] + list(starts[i]) for i in order[0:k]]
+  result = []
+  for i in order:
+   if len(result) >= k and bound[i] >= result[k-1][1]:
+    continue
+   topt = fmin(res_pair, x0=starts[i], xtol=xtol, args=(query, references[i], shape0), disp=0)
+   edist = np.sqrt(res_pair(topt, query, references[i], shape0))
+   if edist > upper[i]:
+    edist = upper[i] ; topt = starts[i]
+   result.append([int(index[i]), edist, topt[0], topt[1], topt[2]])
+   result.sort(key = lambda entry: entry[1])
+  return result[0:k]
+##################################################################################
+##################################################################################
+##### End of functions for rotation invariants and similarity search         #####
+##################################################################################
+##################################################################################
+
+
+
+
+
+##################################################################################
+##################################################################################
+##### Symmetry identification and orientation tracking                      #####
+##################################################################################
+##################################################################################
+##################################################################################
+# Rotation residual for a tensor stored in a RotationMemo
+def res_memo(t, memo, sym, verbose = False):
+ rotated = memo.rotate(t)
+ res = rotated - memo.project(rotated, sym, verbose)
+ return np.dot(res,res)
+##################################################################################
+# Generator that tracks the optimal orientation of each symmetry along a series of
+# tensors (e.g., along an MD trajectory or a strain path), consuming an iterator
+# of tensors (Tensor objects or anything accepted by get_vector_stack for a single
+# tensor) and yielding, for each of them, a list of [sym, edist, tx, ty, tz] as
+# ela_dist, pz_dist and lat_dist with rotate = True. Each search is warm started
+# from the optimum of the same symmetry in the previous frame. A global search
+# (see ResidualPolynomial) is only done for the first frame, or when the distance
+# relative to the norm of the tensor increases by more than jump with respect to
+# the previous frame, in which case the best of both minima is kept. Requires
+# Scipy
+def track_orientation(tensors, symlist = None, form = None, xtol = 1e-8, normalize = False,
+                      jump = 0.02, verbose = False):
+ from scipy.optimize import fmin
+ previous = {}
+ for tensor in tensors:
+  shape0, form, vector = get_vector_stack(tensor, form)
+  if shape0 is None:
+   return
+  vector = vector[0]
+  norm = np.linalg.norm(vector)
+  if symlist == None:
+   symlist = get_default_symlist(shape0)
+  memo = RotationMemo(vector, shape0)
+  result = []
+  for sym in symlist:
+   topt = None
+   if sym in previous:
+    topt = fmin(res_memo, x0=previous[sym][0], xtol=xtol, args=(memo, sym, verbose), disp=0)
+    edist = np.sqrt(res_memo(topt, memo, sym))
+    if edist / norm <= previous[sym][1] + jump:
+     previous[sym] = [topt, edist / norm]
+    else:
+     topt_warm = topt
+     topt = None
+# Global search
+   if topt is None:
+    topt = ResidualPolynomial(vector, sym, shape0, verbose).minimize(xtol)
+    edist = np.sqrt(res_memo(topt, memo, sym))
+    if sym in previous and res_memo(topt_warm, memo, sym) < edist**2:
+     topt = topt_warm
+     edist = np.sqrt(res_memo(topt, memo, sym))
+    previous[sym] = [topt, edist / norm]
+   if normalize:
+    edist = edist / norm
+   result.append([sym, edist, topt[0], topt[1], topt[2]])
+  yield result
+##################################################################################
+# Finds the highest symmetry within a tolerance tol (a distance, relative to the
+# norm of the tensor if normalize = True) for a tensor in vector form. The
+# symmetries in symlist are sorted from high to low symmetry by the number of
+# independent components (the trace of the projector) and checked in that order,
+# stopping at the first one that is accepted:
+#  - Groups whose lower bound from the harmonic decomposition (valid for any
+#    rotation, see harmonic_bounds) is above tol are pruned without any search,
+#    except for the trivial group (e.g., "tic"), whose distance is always zero.
+#  - The distance at zero angles and at the orientations found for the groups
+#    checked before is an upper bound for the rotated distance, and the group is
+#    accepted without search if any of them is below tol.
+#  - Otherwise the rotated search is done (method = "poly", "de" or "fmin", as
+#    in ela_dist) and the group is accepted if the distance is below tol.
+# Returns [sym, edist, tx, ty, tz] for the accepted group (None if none of them
+# is within tol) and the log of the decisions taken, a list of [sym, status]
+# with status "pruned", "accepted (upper bound)", "rejected" or "accepted"
+def find_highest_symmetry(vector, shape0, tol, symlist = None, normalize = False, method = "poly",
+                          xtol = 1e-8, verbose = False):
+ from scipy.optimize import fmin
+ vector = np.array(vector, dtype=float)
+ if symlist == None:
+  symlist = get_default_symlist(shape0)
+ rank = [np.trace(get_projector(shape0, sym, verbose, np.float64)) for sym in symlist]
+ hierarchy = [symlist[i] for i in np.argsort(rank, kind="stable")]
+ scale = 1.
+ if normalize:
+  scale = np.linalg.norm(vector)
+ lower = {}
+ if shape0 in ["elastic", "piezoelectric"]:
+  for sym, bound in harmonic_bounds(vector, shape0, hierarchy, normalize):
+   lower[sym] = bound
+ memo = RotationMemo(vector, shape0)
+ starts = [np.zeros(3)]
+ log = []
+ for sym in hierarchy:
+# The trivial group (identity projector) is never pruned
+  trivial = rank[symlist.index(sym)] >= len(vector) - 0.5
+  if lower.get(sym, 0.) > tol and not trivial:
+   log.append([sym, "pruned"])
+   continue
+# Upper bounds from the orientations tried so far
+  upper = [np.sqrt(res_memo(t, memo, sym)) / scale for t in starts]
+  best = int(np.argmin(upper))
+  if upper[best] <= tol:
+   log.append([sym, "accepted (upper bound)"])
+   t = starts[best]
+   return [sym, upper[best], t[0], t[1], t[2]], log
+  if method == "poly":
+   topt = ResidualPolynomial(vector, sym, shape0, verbose).minimize(xtol)
+  elif method == "de":
+   topt = de_minimize(vector, sym, shape0, xtol = xtol, verbose = verbose)
+  else:
+   topt = fmin(res_memo, x0=starts[best], xtol=xtol, args=(memo, sym, verbose), disp=0)
+  edist = np.sqrt(res_memo(topt, memo, sym)) / scale
+  starts.append(np.array(topt))
+  if edist <= tol:
+   log.append([sym, "accepted"])
+   return [sym, edist, topt[0], topt[1], topt[2]], log
+  log.append([sym, "rejected"])
+ return None, log
+##################################################################################
+# Joint orientation fit of several tensors of the same crystal (e.g., its lattice,
+# elastic and piezoelectric tensors, given as a list of Tensor objects in the same
+# frame), with one shared rotation for all of them. syms gives the symmetry for
+# each tensor (a single label is used for all of them) and the combined residual
+# is sum_k w_k |(I-P_k).v_k(t)|^2 / |v_k|^2 with the given weights (all 1 by
+# default); with normalize = False the residuals are not divided by the norms,
+# in which case the weights must take care of the different units. With method =
+# "poly" the search starts from the global minimum on a grid of angles of the sum
+# of the residual polynomials (see ResidualPolynomial), with method = "fmin" it
+# starts from zero angles. Returns a dictionary with the optimal "angles", the
+# combined "residual" and a list of [sym, edist] for each tensor at the shared
+# orientation ("distances", relative to the norm if normalize = True). Requires
+# Scipy
+def joint_dist(tensors, syms, weights = None, normalize = True, xtol = 1e-8, method = "poly",
+               npoints = 36, verbose = True, printmin = False):
+ from scipy.optimize import fmin
+ disp = 0
+ if printmin:
+  disp = 1
+ if isinstance(syms, str):
+  syms = [syms] * len(tensors)
+ if weights is None:
+  weights = [1.] * len(tensors)
+ memos = [RotationMemo(np.array(t.vector, dtype=float), t.shape[0]) for t in tensors]
+ scales = [1.] * len(tensors)
+ if normalize:
+  scales = [np.dot(memo.vector, memo.vector) for memo in memos]
+ factors = [weights[k] / scales[k] for k in range(0,len(tensors))]
+ def res_joint(t):
+  return sum([factors[k] * res_memo(t, memos[k], syms[k], verbose)
+              for k in range(0,len(tensors))])
+ t0 = [0., 0., 0.]
+ if method == "poly":
+  values = 0.
+  for k in range(0,len(tensors)):
+   angles, grid = ResidualPolynomial(memos[k].vector, syms[k], memos[k].shape0,
+                                     verbose).grid(npoints)
+   values = values + factors[k] * grid
+  i = np.unravel_index(np.argmin(values), values.shape)
+  t0 = [angles[i[0]], angles[i[1]], angles[i[2]]]
+ topt = fmin(res_joint, x0=t0, xtol=xtol, disp=disp)
+ distances = []
+ for k in range(0,len(tensors)):
+  edist = np.sqrt(res_memo(topt, memos[k], syms[k]))
+  if normalize:
+   edist = edist / np.sqrt(scales[k])
+  distances.append([syms[k], edist])
+ result = {"angles": topt, "residual": res_joint(topt), "distances": distances}
+ print_joint_results(result, [t.shape[0] for t in tensors], normalize, verbose)
+ return result
+##################################################################################
+##################################################################################
+##### End of functions for symmetry identification and tracking             #####
+##################################################################################
+##################################################################################
+
+
+
+
+
+##################################################################################
+##################################################################################
+##### Checkpointed batch runs over sets of tensors                           #####
+##################################################################################
+##################################################################################
+##################################################################################
+# Runs Tensor.get_distances over a set of tensors (a list of Tensor objects or
+# anything accepted by get_vector_stack), writing the results to directory in
+# chunks of chunksize tensors. Each chunk is stored in its own .npz file (with the
+# indices of the tensors, the distances as an (n,nsym) array and, with rotate =
+# True, the angles as an (n,nsym,3) array), written to a temporary file first and
+# then renamed, so that a chunk file only exists once it is complete. The
+# settings of the run (and a hash of the input tensors) are recorded in
+# manifest.json. If the run is interrupted, calling run_batch again with the same
+# arguments skips the completed chunks and resumes from there. With stable_only =
+# True (elastic tensors only) the mechanically unstable tensors (see
+# born_stability) are filtered out before the distances are computed, their
+# distances being stored as NaN. Returns the merged results, see load_batch
+def run_batch(tensors, directory, symlist = None, form = None, chunksize = 100, rotate = False,
+              xtol = 1e-8, normalize = False, method = "fmin", stable_only = False, verbose = True):
+ settings = init_batch(tensors, directory, symlist, form, chunksize, rotate, xtol, normalize,
+                       method, stable_only, verbose)
+ if settings is None:
+  return None
+ for chunk in range(0,settings["nchunks"]):
+  if not os.path.exists(get_chunk_filename(directory, chunk)):
+   run_batch_chunk(tensors, directory, chunk, settings)
+   if verbose:
+    print("Chunk %i of %i done" % (chunk+1, settings["nchunks"]))
+ return load_batch(directory)
+##################################################################################
+# Creates the output directory and manifest of a batch run, or checks that the
+# existing manifest matches the current settings. Returns the settings, or None if
+# they do not match
+def init_batch(tensors, directory, symlist = None, form = None, chunksize = 100, rotate = False,
+               xtol = 1e-8, normalize = False, method = "fmin", stable_only = False, verbose = True):
+ import hashlib
+ import json
+ shape0, form, vectors = get_vector_stack(tensors, form)
+ if shape0 is None:
+  return None
+ if symlist == None:
+  symlist = get_default_symlist(shape0)
+ ntensors = len(vectors)
+ settings = {"shape": shape0, "form": form, "symlist": list(symlist), "ntensors": ntensors,
+             "chunksize": chunksize, "nchunks": (ntensors + chunksize - 1) // chunksize,
+             "rotate": bool(rotate), "xtol": float(xtol), "normalize": bool(normalize),
+             "method": method, "stable_only": bool(stable_only) and shape0 == "elastic",
+             "inputs": hashlib.sha1(np.ascontiguousarray(vectors).tobytes()).hexdigest()}
+ os.makedirs(directory, exist_ok = True)
+ manifest = os.path.join(directory, "manifest.json")
+ if os.path.exists(manifest):
+  with open(manifest) as f:
+   previous = json.load(f)
+  if previous != settings:
+   print_batch_mismatch_warning(directory, verbose)
+   return None
+  return settings
+ temp = manifest + ".%i.tmp" % os.getpid()
+ with open(temp, "w") as f:
+  json.dump(settings, f, indent = 1)
+ os.replace(temp, manifest)
+ return settings
+##################################################################################
+# Name of the file where the results of a chunk are stored
+def get_chunk_filename(directory, chunk):
+ return os.path.join(directory, "chunk_%06i.npz" % chunk)
+##################################################################################
+# Computes and writes the results of one chunk of a batch run
+def run_batch_chunk(tensors, directory, chunk, settings):
+ symlist = settings["symlist"]
+ chunksize = settings["chunksize"]
+ index = np.arange(chunk*chunksize, min((chunk+1)*chunksize, settings["ntensors"]))
+ distances = np.full((len(index), len(symlist)), np.nan)
+ angles = np.full((len(index), len(symlist), 3), np.nan)
+ chunk_tensors = []
+ for n in range(0,len(index)):
+  tensor = tensors[index[n]]
+  if not isinstance(tensor, Tensor):
+# Rows of (N,21) and (N,18) stacks are already in normalized vector form (see
+# get_vector_stack) and rows of (N,9) lattice stacks are flattened matrices
+   tensor = np.array(tensor, dtype=float)
+   if tensor.shape == (9,):
+    tensor = tensor.reshape(3,3)
+   tensor = Tensor(tensor.tolist(), form = settings["form"], verbose = False,
+                   normalized = tensor.shape in [(21,), (18,)])
+  chunk_tensors.append(tensor)
+ stable = np.ones(len(index), dtype=bool)
+ if settings.get("stable_only", False):
+  stable = born_stability(chunk_tensors, verbose = False)["stable"]
+ for n in range(0,len(index)):
+  if not stable[n]:
+   continue
+  tensor = chunk_tensors[n]
+  result = tensor.get_distances(settings["form"], symlist, settings["rotate"], settings["xtol"],
+                                verbose = False, normalize = settings["normalize"],
+                                method = settings["method"])
+  for i in range(0,len(symlist)):
+   distances[n,i] = result[i][1]
+   if settings["rotate"]:
+    angles[n,i] = result[i][2:5]
+ filename = get_chunk_filename(directory, chunk)
+ temp = filename + ".%i.tmp" % os.getpid()
+ with open(temp, "wb") as f:
+  if settings["rotate"]:
+   np.savez(f, index = index, distances = distances, angles = angles, stable = stable)
+  else:
+   np.savez(f, index = index, distances = distances, stable = stable)
+ os.replace(temp, filename)
+##################################################################################
+# Reads the results of a batch run, returning a dictionary with the symlist, the
+# indices of the tensors that are done (sorted), the distances (n,nsym), the
+# angles (n,nsym,3) if the run was done with rotate = True, which tensors passed
+# the stability filter and whether all the chunks are complete
+def load_batch(directory):
+ import json
+ with open(os.path.join(directory, "manifest.json")) as f:
+  settings = json.load(f)
+ nsym = len(settings["symlist"])
+ index = [np.zeros(0, dtype=int)]
+ stable = [np.zeros(0, dtype=bool)]
+ distances = [np.zeros((0,nsym))]
+ angles = [np.zeros((0,nsym,3))]
+ complete = True
+ for chunk in range(0,settings["nchunks"]):
+  filename = get_chunk_filename(directory, chunk)
+  if not os.path.exists(filename):
+   complete = False
+   continue
+  with np.load(filename) as data:
+   index.append(data["index"])
+   stable.append(data["stable"])
+   distances.append(data["distances"])
+   if settings["rotate"]:
+    angles.append(data["angles"])
+ result = {"symlist": settings["symlist"], "index": np.concatenate(index),
+           "distances": np.concatenate(distances), "stable": np.concatenate(stable),
+           "complete": complete}
+ if settings["rotate"]:
+  result["angles"] = np.concatenate(angles)
+ return result
+##################################################################################
+# Worker for sharded batch runs. Several workers (processes on one or more
+# machines sharing the filesystem) can be started with the same arguments. Each
+# of them initializes (or checks) the manifest as run_batch and then claims the
+# chunks that are not done yet by creating a lock file next to the chunk file
+# with os.O_CREAT | os.O_EXCL, which is atomic, so that each chunk is claimed by
+# only one worker. While the chunk is computed, the modification time of the lock
+# is refreshed every "heartbeat" seconds, and the lock is removed when the chunk
+# is done (also if the computation fails). With a timeout (in seconds), locks
+# that have not been refreshed for longer than that are considered stale (e.g.,
+# left by a worker that died) and the chunk is claimed again (see
+# take_stale_lock); timeout must then be larger than heartbeat. A chunk computed
+# twice is harmless since both copies are identical. Returns the number of chunks
+# done by this worker. The results are combined with merge_batch
+def run_shard(tensors, directory, symlist = None, form = None, chunksize = 100, rotate = False,
+              xtol = 1e-8, normalize = False, method = "fmin", stable_only = False, timeout = None,
+              heartbeat = 60., verbose = True):
+ import socket
+ import threading
+ settings = init_batch(tensors, directory, symlist, form, chunksize, rotate, xtol, normalize,
+                       method, stable_only, verbose)
+ if settings is None:
+  return 0
+ worker = "%s %i %i" % (socket.gethostname(), os.getpid(), threading.get_ident())
+ ndone = 0
+ for chunk in range(0,settings["nchunks"]):
+  filename = get_chunk_filename(directory, chunk)
+  lock = filename[:-4] + ".lock"
+  if os.path.exists(filename):
+   continue
+  if timeout is not None and os.path.exists(lock):
+   take_stale_lock(lock, timeout, worker)
+  try:
+   fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+  except FileExistsError:
+   continue
+  with os.fdopen(fd, "w") as f:
+   f.write(worker + "\n")
+  stop = threading.Event()
+  def beat():
+   while not stop.wait(heartbeat):
+    try:
+     os.utime(lock)
+    except OSError:
+     pass
+  thread = threading.Thread(target = beat, daemon = True)
+  thread.start()
+  try:
+# The chunk may have been finished by another worker in the meantime
+   if not os.path.exists(filename):
+    run_batch_chunk(tensors, directory, chunk, settings)
+    ndone += 1
+    if verbose:
+     print("Chunk %i of %i done by %s" % (chunk+1, settings["nchunks"], worker))
+  finally:
+   stop.set()
+   thread.join()
+   release_lock(lock, worker)
+ return ndone
+##################################################################################
+# Takes over a stale lock of a sharded batch run (see run_shard): the lock is
+# atomically renamed to a name private to this worker, so that only one of the
+# workers competing for it gets it. If it turns out to have been refreshed (or
+# re-created by another worker) in the meantime it is put back with os.link,
+# which does not overwrite an existing lock; otherwise it is deleted, leaving the
+# chunk free to be claimed. Returns True if the stale lock was removed
+def take_stale_lock(lock, timeout, worker):
+ import time
+ try:
+  if time.time() - os.path.getmtime(lock) <= timeout:
+   return False
+  private = lock + ".%s.stale" % worker.replace(" ", "_")
+  os.rename(lock, private)
+ except OSError:
+  return False
+ if time.time() - os.path.getmtime(private) <= timeout:
+  try:
+   os.link(private, lock)
+  except OSError:
+   pass
+  os.remove(private)
+  return False
+ os.remove(private)
+ return True
+##################################################################################
+# Removes the lock of a chunk if it still belongs to this worker
+def release_lock(lock, worker):
+ try:
+  with open(lock) as f:
+   owner = f.read().strip()
+  if owner == worker:
+   os.remove(lock)
+ except OSError:
+  pass
+##################################################################################
+# Combines the per-chunk outputs of a (sharded) batch run, see load_batch. The
+# result does not depend on which worker did each chunk. Optionally it is also
+# written to a single .npz file
+def merge_batch(directory, filename = None, verbose = True):
+ result = load_batch(directory)
+ if not result["complete"]:
+  print_batch_incomplete_warning(directory, verbose)
+ if filename is not None:
+  temp = filename + ".%i.tmp" % os.getpid()
+  with open(temp, "wb") as f:
+   np.savez(f, **{key: np.array(result[key]) for key in result})
+  os.replace(temp, filename)
+ return result
+##################################################################################
+# Runs a sharded batch with nworkers local processes (useful on a single machine
+# and to test the sharding) and merges the results. The remaining arguments are
+# passed to run_shard
+def run_local_shards(tensors, directory, nworkers = 2, filename = None, **kwargs):
+ import multiprocessing
+ kwargs["verbose"] = kwargs.get("verbose", False)
+ processes = []
+ for i in range(0,nworkers):
+  process = multiprocessing.Process(target = run_shard, args = (tensors, directory), kwargs = kwargs)
+  process.start()
+  processes.append(process)
+ for process in processes:
+  process.join()
+ return merge_batch(directory, filename, kwargs["verbose"])
+##################################################################################
+##################################################################################
+##### End of functions for batch runs                                        #####
+##################################################################################
+##################################################################################
+
+
+
+
+
+##################################################################################
+##################################################################################
+##### Asynchronous API for use within asyncio applications                   #####
+##################################################################################
+##################################################################################
+##################################################################################
+# Process pool shared by the asynchronous API (and the server) when work should
+# not be run in threads. It is created on first use and kept alive, so that the
+# worker processes only pay the import and setup costs once
+process_pool = None
+def get_process_pool(max_workers = None):
+ global process_pool
+ if process_pool is None:
+  from concurrent.futures import ProcessPoolExecutor
+  process_pool = ProcessPoolExecutor(max_workers = max_workers)
+ return process_pool
+def shutdown_process_pool():
+ global process_pool
+ if process_pool is not None:
+  process_pool.shutdown(cancel_futures = True)
+ process_pool = None
+##################################################################################
+# Runs function(*args, **kwargs) in an executor without blocking the event loop.
+# The executor can be a thread or process pool (None for the default thread pool
+# of the loop) and an optional asyncio.Semaphore bounds the number of calls that
+# run at the same time. If the awaiting task is cancelled, the call is cancelled
+# too if it has not started yet (a call that is running cannot be interrupted,
+# its result is discarded)
+async def run_async(function, *args, executor = None, semaphore = None, **kwargs):
+ import asyncio
+ import functools
+ loop = asyncio.get_running_loop()
+ call = functools.partial(function, *args, **kwargs)
+ if semaphore is None:
+  return await loop.run_in_executor(executor, call)
+ async with semaphore:
+  return await loop.run_in_executor(executor, call)
+##################################################################################
+# Asynchronous batch version of Tensor.get_distances. This is an async generator
+# that yields (index, result) pairs in order of completion for the tensors given
+# (Tensor objects or arrays, which are turned into Tensor objects with the given
+# form). At most concurrency tensors are submitted to the executor at any time and
+# new ones are only submitted as results are consumed, which provides
+# backpressure. Closing the generator (or cancelling the task iterating over it)
+# cancels the pending work. The remaining keyword arguments are passed to
+# get_distances
+async def aget_distances_batch(tensors, concurrency = 4, executor = None, form = None, **kwargs):
+ import asyncio
+ loop = asyncio.get_running_loop()
+ kwargs["verbose"] = kwargs.get("verbose", False)
+ tensors = iter(enumerate(tensors))
+ running = {}
+ try:
+  while True:
+   while len(running) < concurrency:
+    item = next(tensors, None)
+    if item is None:
+     break
+    index, tensor = item
+    if not isinstance(tensor, Tensor):
+     tensor = Tensor(np.array(tensor).tolist(), form = form, verbose = False)
+    future = asyncio.ensure_future(run_async(tensor.get_distances, executor = executor, form = form,
+                                             **kwargs))
+    running[future] = index
+   if len(running) == 0:
+    return
+   done, pending = await asyncio.wait(list(running), return_when = asyncio.FIRST_COMPLETED)
+   for future in done:
+    index = running.pop(future)
+    yield index, future.result()
+ finally:
+  for future in running:
+   future.cancel()
+##################################################################################
+##################################################################################
+##### End of the asynchronous API                                            #####
+##################################################################################
+##################################################################################
+
+
+
+
+
+##################################################################################
+##################################################################################
+##### Local classification server with a pool of warm workers                #####
+##################################################################################
+##################################################################################
+##################################################################################
+# Warms up a worker process: loads Scipy, builds all the projectors (which are
+# then kept in projector_cache) and compiles the JIT kernels if Numba is used
+def warm_worker():
+ import scipy.optimize
+ for shape0 in ["elastic", "piezoelectric", "lattice"]:
+  for sym in get_default_symlist(shape0):
+   get_projector(shape0, sym, False, np.float64)
+ if backend == "numba":
+  kernel_residual(np.zeros(3), np.ones(21), np.eye(21), 0, *get_jit_data())
+##################################################################################
+# Serves one request in a worker: kind is "distances" or "projection", tensor is
+# given as nested lists (any shape accepted by Tensor) and options are passed to
+# get_distances or get_projection. Returns the result as plain lists
+def serve_request(kind, tensor, form = None, options = {}):
+ options = dict(options)
+ options["verbose"] = False
+ tensor = Tensor(tensor, form = form, verbose = False)
+ if kind == "distances":
+  result = tensor.get_distances(**options)
+  return [[row[0]] + [float(x) for x in row[1:]] for row in result]
+ if kind == "projection":
+  return np.array(tensor.get_projection(**options), dtype=float).tolist()
+ raise ValueError("unknown request \"%s\", use \"distances\" or \"projection\"" % kind)
+##################################################################################
+# Starts an HTTP server on host:port (localhost by default, there is no
+# authentication) backed by a pool of nworkers warm worker processes. Tensors are
+# sent as JSON with POST /distances or POST /projection, the body being an object
+# with the "tensor" (nested lists), optionally its "form", and the keyword
+# arguments of get_distances or get_projection (e.g., "symlist", "rotate",
+# "sym", "shapeout"). The reply is {"result": ...} or, with status 400,
+# {"error": ...}. GET /health returns {"status": "ok"}. Runs until interrupted
+# (Ctrl+C or SIGTERM)
+def serve(host = "127.0.0.1", port = 8765, nworkers = None, verbose = True):
+ import json
+ from concurrent.futures import ProcessPoolExecutor
+ from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+ import signal
+ import threading
+ if nworkers is None:
+  nworkers = os.cpu_count() or 1
+ pool = ProcessPoolExecutor(max_workers = nworkers, initializer = warm_worker)
+# Start all the workers now rather than on the first requests. Each worker is
+# warmed up once by the initializer when it starts; the pool only spawns a new
+# worker when none is idle, so one no-op task per worker is submitted before
+# waiting for any of them
+ futures = [pool.submit(os.getpid) for i in range(nworkers)]
+ for future in futures:
+  future.result()
+ class RequestHandler(BaseHTTPRequestHandler):
+  def send_json(self, status, reply):
+   body = json.dumps(reply).encode()
+   self.send_response(status)
+   self.send_header("Content-Type", "application/json")
+   self.send_header("Content-Length", str(len(body)))
+   self.end_headers()
+   self.wfile.write(body)
+  def do_GET(self):
+   if self.path.strip("/") == "health":
+    self.send_json(200, {"status": "ok"})
+   else:
+    self.send_json(404, {"error": "not found"})
+  def do_POST(self):
+   try:
+    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+    tensor = request.pop("tensor")
+    form = request.pop("form", None)
+    result = pool.submit(serve_request, self.path.strip("/"), tensor, form, request).result()
+    self.send_json(200, {"result": result})
+   except Exception as error:
+    self.send_json(400, {"error": "%s: %s" % (type(error).__name__, error)})
+  def log_message(self, format, *args):
+   if verbose:
+    BaseHTTPRequestHandler.log_message(self, format, *args)
+ server = ThreadingHTTPServer((host, port), RequestHandler)
+# Stop cleanly on SIGTERM as well as on Ctrl+C
+ def stop(signum, frame):
+  raise KeyboardInterrupt
+ if threading.current_thread() is threading.main_thread():
+  signal.signal(signal.SIGTERM, stop)
+ if verbose:
+  print("MattPy server listening on http://%s:%i" % (host, server.server_address[1]))
+ try:
+  server.serve_forever()
+ except KeyboardInterrupt:
+  pass
+ finally:
+  server.server_close()
+  pool.shutdown()
+##################################################################################
+# Client for the server started with serve. Sends one tensor and returns the
+# result of get_distances (kind = "distances") or get_projection (kind =
+# "projection") called with the given keyword arguments
+def request_server(kind, tensor, form = None, host = "127.0.0.1", port = 8765, timeout = 600,
+                   **kwargs):
+ import json
+ import urllib.request
+ import urllib.error
+ request = dict(kwargs)
+ request["tensor"] = np.array(tensor, dtype=float).tolist()
+ if form is not None:
+  request["form"] = form
+ http_request = urllib.request.Request("http://%s:%i/%s" % (host, port, kind),
+                                       data = json.dumps(request).encode(),
+                                       headers = {"Content-Type": "application/json"})
+ try:
+  with urllib.request.urlopen(http_request, timeout = timeout) as reply:
+   return json.loads(reply.read())["result"]
+ except urllib.error.HTTPError as error:
+  raise RuntimeError(json.loads(error.read())["error"])
+##################################################################################
+##################################################################################
+##### End of the local classification server                                 #####
+##################################################################################
+##################################################################################
+
+
+
+
+
+##################################################################################
+##################################################################################
+##### Monte Carlo propagation of uncertainties                               #####
+##################################################################################
+##################################################################################
+##################################################################################
+# Draws nsamples perturbed copies of a tensor, adding Gaussian noise with the
+# given standard deviations to its components, and returns them in vector form
+# (nsamples,n) in the given form (the form of the tensor by default). sigma can
+# be a number or an array with the shape of the Voigt matrix (elastic and
+# piezoelectric tensors) or of the lattice matrix. For elastic tensors only the
+# upper triangle of sigma is used, the perturbed Voigt matrices being symmetric.
+# The random generator is seeded (seed = 0 by default)
+def sample_vectors(tensor, sigma, nsamples = 1000, seed = 0, form = None):
+ rng = np.random.default_rng(seed)
+ shape0 = tensor.shape[0]
+ if shape0 == "lattice":
+  base = np.array(tensor.cartesian, dtype=float)
+  samples = base + rng.normal(size=(nsamples,3,3)) * np.array(sigma, dtype=float)
+  return samples.reshape(-1,9)
+ base = np.array(tensor.voigt, dtype=float)
+ noise = rng.normal(size=(nsamples,) + base.shape) * np.array(sigma, dtype=float)
+ if shape0 == "piezoelectric":
+  return vectorize_pz_voigt_batch(base + noise, tensor.form)
+ noise = np.triu(noise) + np.swapaxes(np.triu(noise, 1), -1, -2)
+ samples = base + noise
+ if form in ["C", "S"] and form != tensor.form:
+  return vectorize_ela_voigt_batch(invert_ela_voigt(samples, tensor.form), form)
+ return vectorize_ela_voigt_batch(samples, tensor.form)
+##################################################################################
+# Refines the orientations of a stack of tensors in vector form (N,n) for the
+# symmetry sym, starting from angles (3,) or (N,3), with damped Gauss-Newton
+# steps on the residual vectors (I-P).v(t), all the tensors being done at once
+# (the Jacobians are obtained by central finite differences with batched
+# rotations). A step is only accepted for the tensors whose residual decreases.
+# Returns the refined angles (N,3) and the distances (N,)
+def refine_rotations_batch(vectors, angles, sym, shape0, niter = 5, h = 1e-3):
+ vectors = np.array(vectors, dtype=float)
+ angles = np.array(np.broadcast_to(angles, (len(vectors),3)), dtype=float)
+ complement = np.eye(vectors.shape[-1]) - get_projector(shape0, sym, False, np.float64)
+ def residuals(t):
+  return np.dot(rotate_vector_batch(vectors, rotation_matrix(t), shape0), complement.T)
+ res = residuals(angles)
+ res2 = np.sum(res**2, axis=1)
+ for iteration in range(0,niter):
+  J = np.stack([(residuals(angles + h*np.eye(3)[k]) - residuals(angles - h*np.eye(3)[k])) / (2.*h)
+                for k in range(0,3)], axis=-1)
+  JTJ = np.einsum("nik,nil->nkl", J, J)
+  JTr = np.einsum("nik,ni->nk", J, res)
+  damping = 1e-6 * np.trace(JTJ, axis1=1, axis2=2)[:, None, None] * np.eye(3) + 1e-300
+  step = -np.linalg.solve(JTJ + damping, JTr[..., None])[..., 0]
+  new_res = residuals(angles + step)
+  new_res2 = np.sum(new_res**2, axis=1)
+  better = new_res2 < res2
+  angles[better] += step[better]
+  res[better] = new_res[better]
+  res2[better] = new_res2[better]
+ return angles, np.sqrt(res2)
+##################################################################################
+# Mean and standard deviation of the projection of a tensor with uncertainties
+# onto the symmetry sym, all the samples (see sample_vectors) being projected at
+# once. Returns a dictionary with "mean" and "std" in Voigt notation (Cartesian
+# for lattice matrices)
+def projection_uncertainty(tensor, sym, sigma, nsamples = 1000, seed = 0, form = None,
+                           verbose = True):
+ shape0 = tensor.shape[0]
+ if form not in ["C", "S"] or shape0 != "elastic":
+  form = tensor.form
+ vectors = sample_vectors(tensor, sigma, nsamples, seed, form)
+ projected = project_batch(vectors, sym, shape0, verbose)
+ if shape0 == "elastic":
+  projected = tensorize_ela_voigt_batch(projected, form)
+ if shape0 == "piezoelectric":
+  projected = tensorize_pz_voigt_batch(projected, form)
+ if shape0 == "lattice":
+  projected = projected.reshape(-1,3,3)
+ return {"mean": np.mean(projected, axis=0), "std": np.std(projected, axis=0)}
+##################################################################################
+# Distribution of the distances of a tensor with uncertainties to each symmetry in
+# symlist. Without rotation all the samples are projected at once. With rotate =
+# True the optimal orientation of each symmetry is found for the nominal tensor
+# (see Tensor.get_distances) and used as starting point to refine the
+# orientations of all the samples at once (see refine_rotations_batch). Since
+# the refinement is local, the nominal search must find the global minimum, so
+# it uses method = "poly" by default (a local "fmin" search from the default
+# start can get stuck far from it). Returns a dictionary with the symlist, the
+# mean and standard deviation of the distances (nsym,) and all the sampled
+# distances (nsamples,nsym). If a tolerance tol is given, each sample is assigned
+# the first symmetry in symlist (which should go from high to low symmetry) with
+# distance below tol, and the probability of each assignment is returned too
+# (under the key None for the samples that are not within tol of any symmetry)
+def distance_uncertainty(tensor, sigma, nsamples = 1000, seed = 0, form = None, symlist = None,
+                         rotate = False, xtol = 1e-8, normalize = False, tol = None,
+                         method = "poly", verbose = True):
+ shape0 = tensor.shape[0]
+ if form not in ["C", "S"] or shape0 != "elastic":
+  form = tensor.form
+ if symlist == None:
+  symlist = get_default_symlist(shape0)
+ vectors = sample_vectors(tensor, sigma, nsamples, seed, form)
+ if rotate:
+  nominal = tensor.get_distances(form, symlist, True, xtol, verbose = False, normalize = normalize,
+                                 cache = False, method = method)
+ distances = np.zeros((nsamples, len(symlist)))
+ for i in range(0,len(symlist)):
+  if rotate:
+   distances[:,i] = refine_rotations_batch(vectors, nominal[i][2:5], symlist[i], shape0)[1]
+  else:
+   res = vectors - project_batch(vectors, symlist[i], shape0, verbose)
+   distances[:,i] = np.sqrt(np.sum(res**2, axis=1))
+  if normalize:
+   distances[:,i] /= np.linalg.norm(vectors, axis=1)
+ result = {"symlist": list(symlist), "mean": np.mean(distances, axis=0),
+           "std": np.std(distances, axis=0), "distances": distances}
+ if tol is not None:
+  within = distances <= tol
+  assigned = np.where(np.any(within, axis=1), np.argmax(within, axis=1), -1)
+  probability = {}
+  for i in range(0,len(symlist)):
+   probability[symlist[i]] = np.mean(assigned == i)
+  probability[None] = np.mean(assigned == -1)
+  result["probability"] = probability
+ print_uncertainty_results(result, get_printdist(shape0, form), verbose)
+ return result
+##################################################################################
+##################################################################################
+##### End of functions for uncertainty propagation                           #####
+##################################################################################
+##################################################################################
+
+
+
+
+
+##################################################################################
+##################################################################################
+##### Orientation averaging over textures of polycrystals                     #####
+##################################################################################
+##################################################################################
+##################################################################################
+# Returns n uniformly distributed random rotation matrices (n,3,3), obtained from
+# normalized Gaussian quaternions. The random generator is seeded (seed = 0 by
+# default)
+def random_orientations(n, seed = 0):
+ rng = np.random.default_rng(seed)
+ q = rng.normal(size=(n,4))
+ q = q / np.linalg.norm(q, axis=1)[:, None]
+ w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+ R = np.empty((n,3,3))
+ R[:, 0, 0] = 1. - 2.*(y*y + z*z) ; R[:, 0, 1] = 2.*(x*y - z*w) ; R[:, 0, 2] = 2.*(x*z + y*w)
+ R[:, 1, 0] = 2.*(x*y + z*w) ; R[:, 1, 1] = 1. - 2.*(x*x + z*z) ; R[:, 1, 2] = 2.*(y*z - x*w)
+ R[:, 2, 0] = 2.*(x*z - y*w) ; R[:, 2, 1] = 2.*(y*z + x*w) ; R[:, 2, 2] = 1. - 2.*(x*x + y*y)
+ return R
+##################################################################################
+# Returns n rotation matrices (n,3,3) sampling a fiber texture: the crystal
+# direction "direction" (the z axis by default) is aligned with the sample
+# direction "axis", with a uniformly distributed rotation about it, and tilted
+# away from it by Gaussian-distributed angles of standard deviation "spread" (in
+# degrees) towards random azimuths. spread = 0 gives a perfect fiber texture
+def fiber_orientations(n, axis = [0., 0., 1.], direction = [0., 0., 1.], spread = 0., seed = 0):
+ rng = np.random.default_rng(seed)
+ def align(a, b):
+# Rotation matrix that takes the unit vector a to the unit vector b
+  v = np.cross(a, b)
+  c = np.dot(a, b)
+  if np.linalg.norm(v) < 1e-12:
+   if c > 0.:
+    return np.eye(3)
+   u = perpendicular_directions(a, 1)[0, 0]
+   return 2.*np.outer(u, u) - np.eye(3)
+  K = np.array([[0., -v[2], v[1]], [v[2], 0., -v[0]], [-v[1], v[0], 0.]])
+  return np.eye(3) + K + np.dot(K, K) / (1. + c)
+ a = np.array(direction, dtype=float) / np.linalg.norm(direction)
+ b = np.array(axis, dtype=float) / np.linalg.norm(axis)
+# Spin about the crystal direction, then tilt about a random perpendicular axis,
+# then align the crystal direction with the sample axis
+ phi = rng.uniform(0., 2.*np.pi, n)
+ tilt = np.radians(spread) * rng.normal(size=n)
+ psi = rng.uniform(0., 2.*np.pi, n)
+ u, w = perpendicular_directions(a, 2)[0]
+ spin = rodrigues_batch(a, phi)
+ tilt_axes = np.cos(psi)[:, None] * u + np.sin(psi)[:, None] * w
+ tilt = rodrigues_batch(tilt_axes, tilt)
+ return np.matmul(align(a, b), np.matmul(tilt, spin))
+##################################################################################
+# Rotation matrices (n,3,3) for rotations by the angles theta (n,), in radians,
+# about the unit axes (3,) or (n,3)
+def rodrigues_batch(axes, theta):
+ theta = np.array(theta, dtype=float)
+ axes = np.array(np.broadcast_to(axes, theta.shape + (3,)), dtype=float)
+ K = np.zeros(theta.shape + (3,3))
+ K[..., 0, 1] = -axes[..., 2] ; K[..., 0, 2] = axes[..., 1]
+ K[..., 1, 0] = axes[..., 2] ; K[..., 1, 2] = -axes[..., 0]
+ K[..., 2, 0] = -axes[..., 1] ; K[..., 2, 1] = axes[..., 0]
+ s = np.sin(theta)[..., None, None] ; c = np.cos(theta)[..., None, None]
+ return np.eye(3) + s*K + (1. - c)*np.matmul(K, K)
+##################################################################################
+# Builds the (weighted) orientation average of the rotation operator acting on
+# tensors in vector form, i.e., the (n,n) matrix A such that the average of the
+# rotated vectors v over the orientations is np.dot(v, A). In matrix form the
+# tensors rotate as L.M.N^T, with (L,N) = (Q,Q) for elastic tensors in Kelvin
+# notation (Q from get_mandel_rotation), (R,Q) for piezoelectric ones and (R,R)
+# for lattice matrices, so only the average of L (x) N is needed. It is
+# accumulated chunk by chunk (chunksize orientations at a time, one product per
+# chunk) and then restricted to the n-component basis of the vector form, so A
+# can be applied to any number of tensors. The orientations are given as rotation
+# matrices (N,3,3) or angles in degrees (N,3) (see rotation_matrix)
+def orientation_average_operator(orientations, shape0, weights = None, chunksize = 10000):
+ orientations = np.array(orientations, dtype=float)
+ if orientations.shape[-2:] != (3,3):
+  orientations = rotation_matrix(orientations.reshape(-1,3))
+ orientations = orientations.reshape(-1,3,3)
+ if weights is None:
+  weights = np.ones(len(orientations))
+ weights = np.array(weights, dtype=float)
+ weights = weights / np.sum(weights)
+ n = {"elastic": 21, "piezoelectric": 18, "lattice": 9}[shape0]
+# Shapes of the left and right factors
+ p, q = {"elastic": (6, 6), "piezoelectric": (3, 6), "lattice": (3, 3)}[shape0]
+ LN = np.zeros((p*p, q*q))
+ for i in range(0, len(orientations), chunksize):
+  R = orientations[i:i+chunksize]
+  w = weights[i:i+chunksize]
+  if shape0 == "elastic":
+   L = get_mandel_rotation(R) ; N = L
+  if shape0 == "piezoelectric":
+   L = R ; N = get_mandel_rotation(R)
+  if shape0 == "lattice":
+   L = R ; N = R
+  LN += np.einsum("k,ka,kb->ab", w, L.reshape(-1,p*p), N.reshape(-1,q*q), optimize=True)
+ LN = LN.reshape(p,p,q,q)
+# Rotated average of each basis vector of the vector form
+ if shape0 == "elastic":
+  basis = ela_vector_to_mandel(np.eye(n))
+ else:
+  basis = np.eye(n).reshape(n,p,q)
+ rotated = np.einsum("acbd,icd->iab", LN, basis)
+ if shape0 == "elastic":
+  return ela_mandel_to_vector(rotated)
+ return rotated.reshape(n,n)
+##################################################################################
+# Orientation averages of elastic or piezoelectric tensors (anything accepted by
+# get_vector_stack) over a set of grain orientations, given as rotation matrices
+# (N,3,3) or angles (N,3), e.g., from random_orientations or fiber_orientations,
+# with optional weights (e.g., grain volumes). For elastic tensors the Voigt
+# (average stiffness), Reuss (inverse of the average compliance) and Hill
+# (arithmetic mean of both) stiffness estimates are returned (their inverses for
+# tensors in compliance form). For piezoelectric tensors the Voigt (average e at
+# uniform strain) and Reuss (average d at uniform stress) estimates need the
+# companion elastic tensor(s) of the crystal, in the same frame, given with
+# "elastic" (a Tensor, or a Voigt array or stack in the form elastic_form);
+# without it only the plain average of the piezoelectric tensor in its own form
+# is returned. Returns a dictionary with "V", "R" and "H" (or
+# "average") as stacks in Voigt notation, in the form of the input tensors
+def orientation_average(tensors, orientations, weights = None, form = None, elastic = None,
+                        elastic_form = "C", chunksize = 10000, verbose = True):
+ shape0, form, vectors = get_vector_stack(tensors, form)
+ if shape0 not in ["elastic", "piezoelectric"]:
+  print_check_shape_error(verbose)
+  return None
+ A = orientation_average_operator(orientations, shape0, weights, chunksize)
+ if shape0 == "elastic":
+  mandel = ela_vector_to_mandel(vectors)
+  if form == "S":
+   c_mandel = np.linalg.inv(mandel) ; s_mandel = mandel
+  else:
+   c_mandel = mandel ; s_mandel = np.linalg.inv(mandel)
+  voigt = ela_vector_to_mandel(np.dot(ela_mandel_to_vector(c_mandel), A))
+  reuss = np.linalg.inv(ela_vector_to_mandel(np.dot(ela_mandel_to_vector(s_mandel), A)))
+  result = {"V": voigt, "R": reuss, "H": (voigt + reuss) / 2.}
+  for key in result:
+   if form == "S":
+    result[key] = np.linalg.inv(result[key])
+   result[key] = ela_mandel_to_voigt(result[key], form)
+  return result
+ if elastic is None:
+  return {"average": tensorize_pz_voigt_batch(np.dot(vectors, A), form)}
+ elastic_form, elastic_vectors = get_vector_stack(elastic, elastic_form)[1:]
+ Ashape = orientation_average_operator(orientations, "elastic", weights, chunksize)
+ c_mandel = ela_vector_to_mandel(elastic_vectors)
+ if elastic_form == "S":
+  c_mandel = np.linalg.inv(c_mandel)
+ s_mandel = np.linalg.inv(c_mandel)
+ pz = vectors.reshape(-1,3,6)
+# In vector (Kelvin) form e = d.C and d = e.S are plain matrix products
+ if form == "e":
+  e = pz ; d = np.matmul(pz, s_mandel)
+ else:
+  d = pz ; e = np.matmul(pz, c_mandel)
+ c_avg = ela_vector_to_mandel(np.dot(ela_mandel_to_vector(c_mandel), Ashape))
+ s_avg = ela_vector_to_mandel(np.dot(ela_mandel_to_vector(s_mandel), Ashape))
+ e_voigt = np.dot(e.reshape(-1,18), A).reshape(-1,3,6)
+ d_reuss = np.dot(d.reshape(-1,18), A).reshape(-1,3,6)
+ if form == "e":
+  voigt = e_voigt ; reuss = np.matmul(d_reuss, np.linalg.inv(s_avg))
+ else:
+  voigt = np.matmul(e_voigt, np.linalg.inv(c_avg)) ; reuss = d_reuss
+ result = {"V": voigt, "R": reuss, "H": (voigt + reuss) / 2.}
+ for key in result:
+  result[key] = tensorize_pz_voigt_batch(result[key].reshape(-1,18), form)
+ return result
+##################################################################################
+##################################################################################
+##### End of functions for orientation averaging                              #####
+##################################################################################
+##################################################################################
+
+
+
+
+
+##################################################################################
+##################################################################################
+##### Persistent on-disk cache of distance results                           #####
+##################################################################################
+##################################################################################
+##################################################################################
+# Cache used by Tensor.get_distances when no cache is passed explicitly. It is
+# disabled (None) unless enable_distance_cache is called
+distance_cache = None
+##################################################################################
+# File-backed cache of distance results (requires the sqlite3 module from the
+# Python standard library). Each entry is a row of the result list returned by
+# ela_dist, pz_dist or lat_dist for a single symmetry, stored under a key that is
+# a hash of the tensor components, the shape and form, the symmetry and the
+# optimizer settings (see get_key). When there are more than maxsize entries the
+# least recently used ones are evicted. The cache can be used from several
+# threads (e.g., the executor threads of run_async): the connection is shared and
+# all the accesses to it are serialized with a lock
+class DistanceCache:
+ def __init__(self, path = "mattpy_cache.sqlite", maxsize = 100000):
+  import sqlite3
+  import threading
+  self.path = path
+  self.maxsize = maxsize
+  self.lock = threading.RLock()
+  self.connection = sqlite3.connect(path, check_same_thread = False)
+  with self.lock, self.connection:
+   self.connection.execute("CREATE TABLE IF NOT EXISTS distances "
+                           "(key TEXT PRIMARY KEY, value TEXT, atime REAL)")
+   self.connection.execute("CREATE INDEX IF NOT EXISTS distances_atime ON distances (atime)")
+ def __len__(self):
+  with self.lock:
+   return self.connection.execute("SELECT COUNT(*) FROM distances").fetchone()[0]
+# Key method: sha1 hash of the settings and of the exact (float64) components of
+# the tensor in vector form
+ def get_key(self, shape0, form, vector, sym, rotate, xtol, normalize, method = "fmin"):
+  import hashlib
+  header = "%s:%s:%s:%s:%r:%s:%s:" % (shape0, form, sym, bool(rotate), float(xtol), bool(normalize),
+                                      method)
+  vector = np.ascontiguousarray(vector, dtype=np.float64)
+  return hashlib.sha1(header.encode() + vector.tobytes()).hexdigest()
+# Get method: returns the stored result row, or None if the key is not in the
+# cache. Reading an entry updates its access time
+ def get(self, key):
+  import json
+  import time
+  with self.lock:
+   entry = self.connection.execute("SELECT value FROM distances WHERE key = ?", (key,)).fetchone()
+   if entry is None:
+    return None
+   with self.connection:
+    self.connection.execute("UPDATE distances SET atime = ? WHERE key = ?", (time.time(), key))
+  row = json.loads(entry[0])
+  return [row[0]] + [np.float64(x) for x in row[1:]]
+# Put method: stores a result row and evicts the least recently used entries if
+# the cache is full
+ def put(self, key, row):
+  import json
+  import time
+  value = json.dumps([row[0]] + [float(x) for x in row[1:]])
+  with self.lock, self.connection:
+   self.connection.execute("INSERT OR REPLACE INTO distances VALUES (?, ?, ?)",
+                           (key, value, time.time()))
+   nexcess = len(self) - self.maxsize
+   if nexcess > 0:
+    self.connection.execute("DELETE FROM distances WHERE key IN (SELECT key FROM distances "
+                            "ORDER BY atime LIMIT ?)", (nexcess,))
+ def clear(self):
+  with self.lock, self.connection:
+   self.connection.execute("DELETE FROM distances")
+ def close(self):
+  with self.lock:
+   self.connection.close()
+##################################################################################
+# Enables (disables) the default cache used by Tensor.get_distances
+def enable_distance_cache(path = "mattpy_cache.sqlite", maxsize = 100000):
+ global distance_cache
+ distance_cache = DistanceCache(path, maxsize)
+ return distance_cache
+def disable_distance_cache():
+ global distance_cache
+ if distance_cache is not None:
+  distance_cache.close()
+ distance_cache = None
+##################################################################################
+##################################################################################
+##### End of functions for the distance cache                                #####
+##################################################################################
+##################################################################################
+
+
+
+
+
+##################################################################################
+##################################################################################
+##### Optional JIT-compiled kernels for the rotation optimization            #####
+##################################################################################
+##################################################################################
+##################################################################################
+# Tells whether Numba is installed, without importing it
+def numba_available():
+ import importlib.util
+ return importlib.util.find_spec("numba") is not None
+##################################################################################
+# Backend used by the rotation kernels: "numba" if Numba is available, "numpy"
+# otherwise. It can be changed with set_backend
+backend = "numpy"
+if numba_available():
+ backend = "numba"
+##################################################################################
+# Selects the backend ("numba" or "numpy") used by rotate_ela, rotate_pz and the
+# rotation optimization in ela_dist, pz_dist and lat_dist
+def set_backend(name, verbose = True):
+ global backend
+ if name == "numba" and not numba_available():
+  print_no_numba_warning(verbose)
+  name = "numpy"
+ if name in ["numba", "numpy"]:
+  backend = name
+ return backend
+##################################################################################
+# Registers a kernel to be compiled in nopython mode with Numba. The kernels are
+# written with explicit loops so that they can be compiled, and are only called
+# when the "numba" backend is selected (the pure-NumPy functions are used
+# otherwise). Numba is imported, and all the kernels are compiled, the first time
+# one of them is called (see compile_kernels), so that importing MattPy does not
+# pay for it
+jit_kernels = []
+def jit_kernel(function):
+ jit_kernels.append(function)
+ def kernel(*args):
+  compile_kernels()
+  return globals()[function.__name__](*args)
+ kernel.__name__ = function.__name__
+ kernel.__doc__ = function.__doc__
+ return kernel
+##################################################################################
+# Replaces the registered kernels by their Numba-compiled versions (or by the
+# plain Python functions if Numba is not available). All the module names are
+# rebound before anything is compiled, so that kernels calling other kernels get
+# the compiled versions
+kernels_compiled = []
+def compile_kernels():
+ if kernels_compiled:
+  return
+ try:
+  import numba
+  compiled = [numba.njit(cache = True)(function) for function in jit_kernels]
+ except ImportError:
+  compiled = list(jit_kernels)
+ for function, kernel in zip(jit_kernels, compiled):
+  globals()[function.__name__] = kernel
+ kernels_compiled.append(True)
+##################################################################################
+# Constant arrays used by the kernels: the matrix that builds the Kelvin (Mandel)
+# rotation from R (see get_mandel_rotation), the indices of the upper triangle of
+# a 6x6 matrix and the corresponding factors of the 21-vector form
+jit_data = []
+def get_jit_data():
+ if len(jit_data) == 0:
+  basis = get_mandel_basis()
+  kernel = np.einsum("Iab,Jcd->acbdIJ", basis, basis).reshape(81,36)
+  i, j = np.triu_indices(6)
+  jit_data.extend([np.ascontiguousarray(kernel), i.astype(np.int64), j.astype(np.int64),
+                   np.where(i == j, 1., np.sqrt(2.))])
+ return jit_data
+##################################################################################
+# Rotation matrix R = Rz.Ry.Rx for angles t (degrees), see rotation_matrix
+@jit_kernel
+def kernel_rotation_matrix(t):
+ f = np.pi / 180.
+ cx = np.cos(f*t[0]) ; sx = np.sin(f*t[0])
+ cy = np.cos(f*t[1]) ; sy = np.sin(f*t[1])
+ cz = np.cos(f*t[2]) ; sz = np.sin(f*t[2])
+ R = np.empty((3,3))
+ R[0,0] = cz*cy ; R[0,1] = cz*sy*sx - sz*cx ; R[0,2] = cz*sy*cx + sz*sx
+ R[1,0] = sz*cy ; R[1,1] = sz*sy*sx + cz*cx ; R[1,2] = sz*sy*cx - cz*sx
+ R[2,0] = -sy   ; R[2,1] = cy*sx            ; R[2,2] = cy*cx
+ return R
+##################################################################################
+# Rotates a Cartesian rank-4 (rank-3) tensor by R, contracting one index at a time
+@jit_kernel
+def kernel_rotate_cart4(c, R):
+ result = c.copy()
+ for axis in range(0,4):
+  temp = np.zeros((3,3,3,3))
+  for i in range(0,3):
+   for j in range(0,3):
+    for k in range(0,3):
+     for l in range(0,3):
+      for m in range(0,3):
+       if axis == 0:
+        temp[i,j,k,l] += R[i,m]*result[m,j,k,l]
+       elif axis == 1:
+        temp[i,j,k,l] += R[j,m]*result[i,m,k,l]
+       elif axis == 2:
+        temp[i,j,k,l] += R[k,m]*result[i,j,m,l]
+       else:
+        temp[i,j,k,l] += R[l,m]*result[i,j,k,m]
+  result = temp
+ return result
+@jit_kernel
+def kernel_rotate_cart3(e, R):
+ result = e.copy()
+ for axis in range(0,3):
+  temp = np.zeros((3,3,3))
+  for i in range(0,3):
+   for j in range(0,3):
+    for k in range(0,3):
+     for m in range(0,3):
+      if axis == 0:
+       temp[i,j,k] += R[i,m]*result[m,j,k]
+      elif axis == 1:
+       temp[i,j,k] += R[j,m]*result[i,m,k]
+      else:
+       temp[i,j,k] += R[k,m]*result[i,j,m]
+  result = temp
+ return result
+##################################################################################
+# Rotates a tensor in vector form by angles t, see rotate_vector_batch. The code
+# is 0 (elastic), 1 (piezoelectric) or 2 (lattice) and the remaining arguments are
+# those returned by get_jit_data
+@jit_kernel
+def kernel_rotate_vector(t, vector, code, kernel, iu, ju, coeff):
+ R = kernel_rotation_matrix(t)
+ rotated = np.zeros(vector.shape[0])
+ if code == 2:
+  for i in range(0,3):
+   for j in range(0,3):
+    for a in range(0,3):
+     for b in range(0,3):
+      rotated[3*i+j] += R[i,a]*R[j,b]*vector[3*a+b]
+  return rotated
+# Kelvin (Mandel) rotation matrix
+ Q = np.zeros((6,6))
+ for a in range(0,3):
+  for c in range(0,3):
+   for b in range(0,3):
+    for d in range(0,3):
+     rr = R[a,c]*R[b,d]
+     row = 27*a + 9*c + 3*b + d
+     for I in range(0,6):
+      for J in range(0,6):
+       Q[I,J] += rr*kernel[row,6*I+J]
+ if code == 1:
+  for i in range(0,3):
+   for J in range(0,6):
+    for a in range(0,3):
+     for K in range(0,6):
+      rotated[6*i+J] += R[i,a]*vector[6*a+K]*Q[J,K]
+  return rotated
+ M = np.zeros((6,6))
+ for n in range(0,21):
+  M[iu[n],ju[n]] = vector[n] / coeff[n]
+  M[ju[n],iu[n]] = vector[n] / coeff[n]
+ QM = np.zeros((6,6))
+ for I in range(0,6):
+  for J in range(0,6):
+   for K in range(0,6):
+    QM[I,J] += Q[I,K]*M[K,J]
+ for n in range(0,21):
+  temp = 0.
+  for K in range(0,6):
+   temp += QM[iu[n],K]*Q[ju[n],K]
+  rotated[n] = temp * coeff[n]
+ return rotated
+##################################################################################
+# Rotation residual |(I-P).v(t)|^2 for a tensor in vector form and a projector
+# matrix P, see res_ela, res_pz and res_lat
+@jit_kernel
+def kernel_residual(t, vector, projector, code, kernel, iu, ju, coeff):
+ rotated = kernel_rotate_vector(t, vector, code, kernel, iu, ju, coeff)
+ result = 0.
+ for i in range(0,rotated.shape[0]):
+  res = rotated[i]
+  for j in range(0,rotated.shape[0]):
+   res -= projector[i,j]*rotated[j]
+  result += res*res
+ return result
+##################################################################################
+##################################################################################
+##### End of JIT-compiled kernels                                            #####
+##################################################################################
+##################################################################################
+
+
+
+
+
+##################################################################################
+# Running this file starts the local classification server (see serve)
+if __name__ == "__main__":
+ import argparse
+ parser = argparse.ArgumentParser(description = "MattPy local classification server")
+ parser.add_argument("--host", default = "127.0.0.1")
+ parser.add_argument("--port", type = int, default = 8765)
+ parser.add_argument("--workers", type = int, default = None)
+ parser.add_argument("--quiet", action = "store_true")
+ arguments = parser.parse_args()
+ serve(arguments.host, arguments.port, arguments.workers, not arguments.quiet)